@@ -7,10 +7,17 @@ from flask import request
 from flask import Response
 import translator
 import solr
+import cache
+import decoder_pool
+import jobs
+import translation_memory
 
 
 class AppTranslator:
 
+    # Decoder types accepted by _create_decoder()
+    DECODERS = ['moses', 'lamtram', 'solr', 'tensorflow', 'compare']
+
     DEFAULT_CONFIG = {
         'debug': False,
         'port': 5000,
@@ -18,6 +25,23 @@ class AppTranslator:
         'lamtram': '/home/vagrant/lamtram',
         'solr': '/home/vagrant/solr',
         'solr_url': 'http://localhost:8983',
+        'solr_connect_timeout': 5,  # Max. number of seconds to connect to Solr
+        'solr_read_timeout': 60,  # Max. number of seconds to wait for data of a Solr response
+        'moses_pool_size': 1,  # Number of warm Moses processes per language pair and settings
+        'tensorflow_pool_size': 1,  # Number of resident TensorFlow decoders per model
+        'decoder_timeout': 300,  # Max. number of seconds a decoder process may take for a request
+        'decoder_memory_budget': 0,  # Max. memory (MB) of resident decoders, least recently used ones are stopped
+        'solr_cache_size': 100000,  # Max. number of strings with translations cached by the Solr baseline system
+        'solr_cache_file': '',  # Path to a SQLite database persisting the cache, e.g. data/cache/solr.db
+        # Max. number of seconds per backend in compare mode, slower backends are reported as failed
+        'compare_timeouts': {'moses': 120, 'tensorflow': 120, 'solr': 120},
+        # Number of threads running translation jobs (see /jobs) per decoder type, missing types get one thread
+        'job_workers': {'moses': 1, 'lamtram': 1, 'tensorflow': 1, 'solr': 2, 'compare': 1},
+        'job_queue_size': 100,  # Max. number of waiting jobs per decoder type
+        'stream_chunk_size': 50,  # Number of strings translated at once by /translateXMLStream
+        'translation_memory': False,  # Serve strings translated before by the same decoder and settings from a store
+        'translation_memory_size': 1000000,  # Max. number of strings in the translation memory
+        'translation_memory_file': 'data/cache/translation_memory.db',  # SQLite database, relative to the app root
     }
 
     def __init__(self, config):
@@ -32,6 +56,14 @@ class AppTranslator:
         if not os.path.isdir(upload_folder):
             os.makedirs(upload_folder)
         self.app.config['UPLOAD_FOLDER'] = upload_folder
+        self.jobs = jobs.JobQueue(self.DECODERS, self.config['job_workers'], self.config['job_queue_size'])
+        # Connections to Solr are kept alive and shared by all requests
+        solr.get_transport(self.config['solr_url'], self.config['solr_connect_timeout'], self.config['solr_read_timeout'])
+        # Create the process-wide cache of the Solr baseline system, shared by all requests
+        cache.get_cache('solr', self.config['solr_cache_size'], self.config['solr_cache_file'])
+        if self.config['translation_memory']:
+            db_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', self.config['translation_memory_file'])
+            cache.get_cache('translation_memory', self.config['translation_memory_size'], db_file)
 
     def init_routes(self):
         @self.app.after_request
@@ -54,23 +86,53 @@ class AppTranslator:
 
         @self.app.route('/translateXML', methods=['POST'])
         def translate_xml():
+            data = json.loads(request.data)
+            out = json.dumps(self._translate_xml(data))
+            return Response(out, mimetype='application/json')
+
+        @self.app.route('/translateXMLStream', methods=['POST'])
+        def translate_xml_stream():
+            # Same data as /translateXML, translated rows are streamed as newline-delimited JSON
             data = json.loads(request.data)
             trans = self._get_decoder(data['decoder'], data['decoder_settings'])
             xml_file = os.path.join(self.app.config['UPLOAD_FOLDER'], data['xml_filename'])
-            out = json.dumps(trans.translate_xml(xml_file, data['lang_from'], data['lang_to']))
-            return Response(out, mimetype='application/json')
+            chunk_size = int(data.get('chunk_size', self.config['stream_chunk_size']))
+            rows = trans.translate_xml_stream(xml_file, data['lang_from'], data['lang_to'], chunk_size)
+            return Response((json.dumps(row) + '\n' for row in rows), mimetype='application/x-ndjson')
 
         @self.app.route('/translateStrings', methods=['POST'])
         def get_translation():
             data = json.loads(request.data)
-            trans = self._get_decoder(data['decoder'], data['decoder_settings'])
-            out = json.dumps(trans.get(data['strings'], data['lang_from'], data['lang_to']))
+            out = json.dumps(self._translate_strings(data))
+            return Response(out, mimetype='application/json')
+
+        @self.app.route('/jobs', methods=['POST'])
+        def submit_job():
+            # Same data as for /translateXML (if 'xml_filename' is given) or /translateStrings
+            data = json.loads(request.data)
+            if data.get('decoder') not in self.DECODERS:
+                return Response(json.dumps({'success': False, 'error': 'Unknown decoder'}), status=400,
+                                mimetype='application/json')
+            func = self._translate_xml if 'xml_filename' in data else self._translate_strings
+            try:
+                job = self.jobs.submit(data['decoder'], func, data)
+                out = json.dumps({'success': True, 'id': job.id})
+            except jobs.JobQueueFull as e:
+                out = json.dumps({'success': False, 'error': str(e)})
             return Response(out, mimetype='application/json')
 
+        @self.app.route('/jobs/<id>')
+        def get_job(id):
+            job = self.jobs.get(id)
+            if not job:
+                return Response(json.dumps({'success': False, 'error': 'Job not found'}), status=404,
+                                mimetype='application/json')
+            return Response(json.dumps(job.to_dict()), mimetype='application/json')
+
         @self.app.route('/getTopTerms')
         def get_top_terms():
             lang = request.args.get('lang')
-            s = solr.Solr(self.config['solr'])
+            s = solr.get_solr(self.config['solr_url'])
             terms = s.get_top_terms(lang, 100)
             return Response(json.dumps(terms), mimetype='application/json')
 
@@ -79,19 +141,47 @@ class AppTranslator:
             source = request.args.get('source')
             target = request.args.get('target')
             term = request.args.get('term')
-            s = solr.Solr(self.config['solr'], self.config['solr_url'])
+            s = solr.get_solr(self.config['solr_url'])
             terms = s.get_term_variations(source, target, term)
             return Response(json.dumps(terms), mimetype='application/json')
 
+        @self.app.route('/getStats')
+        def get_stats():
+            stats = {
+                'caches': cache.get_stats(),
+                'decoders': decoder_pool.get_status(),
+                'translation_memory': translation_memory.get_stats(),
+                'solr': solr.get_stats(),
+            }
+            return Response(json.dumps(stats), mimetype='application/json')
+
+    def _translate_xml(self, data):
+        trans = self._get_decoder(data['decoder'], data['decoder_settings'])
+        xml_file = os.path.join(self.app.config['UPLOAD_FOLDER'], data['xml_filename'])
+        return trans.translate_xml(xml_file, data['lang_from'], data['lang_to'])
+
+    def _translate_strings(self, data):
+        trans = self._get_decoder(data['decoder'], data['decoder_settings'])
+        return trans.get(data['strings'], data['lang_from'], data['lang_to'])
+
     def _get_decoder(self, type, settings):
+        trans = self._create_decoder(type, settings)
+        if self.config['translation_memory'] and type != 'compare':
+            return translation_memory.TranslationMemory(trans, cache.get_cache('translation_memory'))
+        return trans
+
+    def _create_decoder(self, type, settings):
         if type == 'moses':
-            return translator.TranslatorMoses(self.config['moses'], settings)
+            return translator.TranslatorMoses(self.config['moses'], settings, self.config['moses_pool_size'],
+                                              self.config['decoder_timeout'], self.config['decoder_memory_budget'])
         elif type == 'lamtram':
             return translator.TranslatorLamtram(self.config['lamtram'], settings)
         elif type == 'solr':
             return translator.TranslatorSolr(self.config['solr_url'], settings)
         elif type == 'tensorflow':
-            return translator.TranslatorTensorflow(settings)
+            return translator.TranslatorTensorflow(settings, self.config['tensorflow_pool_size'],
+                                                   self.config['decoder_timeout'],
+                                                   self.config['decoder_memory_budget'])
         elif type == 'compare':
             return translator.TranslatorCompare(self.config, settings)
 
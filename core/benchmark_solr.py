@@ -0,0 +1,98 @@
+import os
+import sys
+import getopt
+import time
+from translator import TranslatorSolr
+from cache import LRUCache
+
+"""
+Benchmark the Solr baseline system: Translate the strings of an input file with different settings and report the
+number of requests sent to Solr. The translations of each mode are compared to the ones of the first mode.
+
+Modes:
+single      One request per aligned document, substring heuristic
+batch       Aligned documents fetched with batched lookups, substring heuristic
+lattice     Phrases of all spans fetched in bulk (two requests per string), lattice segmentation. The translations may
+            differ from the heuristic, "different" counts them
+
+Usage:
+$ python benchmark_solr.py --input=/path/to/strings.en --source_lang=en --target_lang=fr --modes=batch,lattice
+
+Arguments:
+--input             File containing one string per line
+--source_lang       Source language (default='en')
+--target_lang       Target language (default='fr')
+--solr_url          URL to access Solr (default='http://localhost:8983')
+--limit             Max. number of strings to translate (default=100)
+--modes             Comma separated list of modes to compare (default='single,batch,lattice')
+
+@author Stefan Wanzenried <stefan.wanzenried@gmail.com>
+"""
+
+MODES = {
+    'single': {'batch_lookups': False, 'segmentation': 'heuristic'},
+    'batch': {'batch_lookups': True, 'segmentation': 'heuristic'},
+    'lattice': {'batch_lookups': True, 'segmentation': 'lattice'},
+}
+
+
+def benchmark(strings, source_lang, target_lang, solr_url, config):
+    # Use a separate cache, otherwise a run is served from the cache filled by the previous one
+    trans = TranslatorSolr(solr_url, config, LRUCache())
+    n_requests = trans.solr.get_thread_requests()
+    start = time.time()
+    translations = []
+    for string in strings:
+        translations.append(trans.get([string], source_lang, target_lang)['translations'][0])
+    return translations, trans.solr.get_thread_requests() - n_requests, time.time() - start
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:s:t:u:l:m:', ['input=', 'source_lang=', 'target_lang=', 'solr_url=', 'limit=', 'modes='])
+    except getopt.GetoptError as err:
+        print str(err)
+        sys.exit(2)
+
+    input = ''
+    source_lang = 'en'
+    target_lang = 'fr'
+    solr_url = 'http://localhost:8983'
+    limit = 100
+    modes = ['single', 'batch', 'lattice']
+    for opt, arg in opts:
+        if opt in ('-i', '--input'):
+            input = arg
+        if opt in ('-s', '--source_lang'):
+            source_lang = arg
+        if opt in ('-t', '--target_lang'):
+            target_lang = arg
+        if opt in ('-u', '--solr_url'):
+            solr_url = arg
+        if opt in ('-l', '--limit'):
+            limit = int(arg)
+        if opt in ('-m', '--modes'):
+            modes = arg.split(',')
+
+    if not os.path.isfile(input):
+        print "Input file does not exist"
+        sys.exit(2)
+
+    for mode in modes:
+        if mode not in MODES:
+            print "Unknown mode '" + mode + "'"
+            sys.exit(2)
+
+    with open(input) as f:
+        strings = [line.strip() for line in f if line.strip()][:limit]
+    if not strings:
+        print "Input file does not contain any strings"
+        sys.exit(2)
+
+    print "mode;strings;requests;requests_per_string;seconds;different_translations"
+    reference = None
+    for mode in modes:
+        translations, n_requests, seconds = benchmark(strings, source_lang, target_lang, solr_url, MODES[mode])
+        reference = translations if reference is None else reference
+        different = len([i for i, translation in enumerate(translations) if translation != reference[i]])
+        print '%s;%d;%d;%.2f;%.2f;%d' % (mode, len(strings), n_requests, n_requests / float(len(strings)), seconds, different)
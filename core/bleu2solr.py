@@ -1,5 +1,6 @@
 import translations2solr
 import solr
+import folds
 import os
 import getopt
 import sys
@@ -9,35 +10,50 @@ class Bleu2Solr(object):
     Create separate cores in Solr for measuring BLEU score
     """
 
-    def __init__(self, files_train, languages, run, solr):
+    def __init__(self, files_train, languages, run, solr, folds_file=''):
         """
         :param files_train: [source-language-filepath, target-language-filepath]
         :param languages: [source-lang, target-lang]
         :param run: Corresponding run
         :param solr: Instance of Solr class
+        :param folds_file: Optional fold index (folds.json) written by write_corpus_bleu.py, the training data of the
+        run is read from the index instead of files_train
         """
         self.files_train = files_train
         self.languages = languages
         self.run = run
-        self.dir_out = os.path.dirname(files_train[0])
+        self.folds = folds.Folds(folds_file) if folds_file else None
+        if self.folds:
+            self.dir_out = os.path.join(os.path.dirname(os.path.realpath(folds_file)), 'run-' + str(run))
+        else:
+            self.dir_out = os.path.dirname(files_train[0])
         self.solr = solr
 
     def index(self):
         """
         Write Solr XML files (stored in same folder as given training data) and index data into Solr
         """
-        for i, file_train in enumerate(self.files_train):
-            lang = self.languages[i]
-            xml_file = self._write_solr_xml(file_train, lang)
+        if not os.path.isdir(self.dir_out):
+            os.makedirs(self.dir_out)
+        for i, lang in enumerate(self.languages):
+            xml_file = self._write_solr_xml(self._get_sentences(i, lang), lang)
             self._index(xml_file, lang)
 
-    def _write_solr_xml(self, file_train, lang):
+    def _get_sentences(self, i, lang):
+        if self.folds:
+            for sentence in self.folds.get_lines(self.run, 'train', lang):
+                yield sentence
+        else:
+            with open(self.files_train[i], 'r') as f:
+                for sentence in f:
+                    yield sentence
+
+    def _write_solr_xml(self, sentences, lang):
         xml_file = os.path.join(self.dir_out, lang + '.xml')
         app_id = 'run-' + str(self.run)  # Fake an app ID
         translations = {}
-        with open(file_train, 'r') as f:
-            for i, sentence in enumerate(f.readlines()):
-                translations['key_' + str(i)] = sentence.strip()  # Fake a key
+        for i, sentence in enumerate(sentences):
+            translations['key_' + str(i)] = sentence.strip()  # Fake a key
         writer = translations2solr.SolrXMLWriter(xml_file)
         writer.write(app_id, translations)
         return xml_file
@@ -50,7 +66,7 @@ class Bleu2Solr(object):
 
 if __name__ == '__main__':
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'l:f:r:s:', ['languages=', 'files_train=', 'run=', 'dir_solr='])
+        opts, args = getopt.getopt(sys.argv[1:], 'l:f:r:s:i:', ['languages=', 'files_train=', 'run=', 'dir_solr=', 'folds='])
     except getopt.GetoptError as err:
         print str(err)
         sys.exit(2)
@@ -59,6 +75,7 @@ if __name__ == '__main__':
     files_train = []
     run = 0
     dir_solr = ''
+    folds_file = ''
     for opt, arg in opts:
         if opt in ('-l', '--languages'):
             languages = arg.split(',')
@@ -68,7 +85,9 @@ if __name__ == '__main__':
             run = arg
         if opt in ('-s', '--dir_solr'):
             dir_solr = arg
+        if opt in ('-i', '--folds'):
+            folds_file = arg
 
     solr = solr.Solr(dir_solr)
-    app = Bleu2Solr(files_train, languages, run, solr)
+    app = Bleu2Solr(files_train, languages, run, solr, folds_file)
     app.index()
@@ -0,0 +1,158 @@
+import collections
+import threading
+import sqlite3
+import json
+import time
+import os
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory cache evicting the least recently used entries once the max. number of entries is reached.
+    Optionally backed by a SQLite database, so that entries survive restarts of the application.
+    """
+
+    def __init__(self, max_entries=100000, db_file=''):
+        """
+        max_entries -- Max. number of entries kept in memory (and on disk)
+        db_file -- Path to a SQLite database storing the entries on disk, no persistence if empty
+        """
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.store = SQLiteStore(db_file, max_entries) if db_file else None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the cached value or None if the key is not cached
+        """
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+        value = self.store.get(key) if self.store else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self._set(key, value)
+        if self.store:
+            self.store.set(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.store:
+            self.store.clear()
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+        if self.store:
+            stats['entries_disk'] = self.store.n_entries
+        return stats
+
+    def _set(self, key, value):
+        if key in self.entries:
+            del self.entries[key]
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+class SQLiteStore(object):
+    """
+    Key/value store in a SQLite database, values must be serializable to JSON.
+    The least recently accessed entries are deleted once the max. number of entries is exceeded.
+    """
+
+    def __init__(self, db_file, max_entries=0):
+        """
+        db_file -- Path to the SQLite database, created if it does not exist
+        max_entries -- Max. number of entries, 0 means unlimited
+        """
+        dir_db = os.path.dirname(os.path.realpath(db_file))
+        if not os.path.isdir(dir_db):
+            os.makedirs(dir_db)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, accessed REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.connection.commit()
+        self.n_entries = self.count()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self.lock:
+            cursor = self.connection.execute('UPDATE entries SET value = ?, accessed = ? WHERE key = ?',
+                                             (json.dumps(value), time.time(), key))
+            if not cursor.rowcount:
+                self.connection.execute('INSERT INTO entries (key, value, accessed) VALUES (?, ?, ?)',
+                                        (key, json.dumps(value), time.time()))
+                self.n_entries += 1
+            if self.max_entries and self.n_entries > self.max_entries:
+                self._evict()
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM entries')
+            self.connection.commit()
+            self.n_entries = 0
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def _evict(self):
+        # Delete 10% more than necessary, so that we do not need to evict on every insert
+        n = self.n_entries - self.max_entries + self.max_entries // 10
+        self.connection.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)', (n,))
+        self.n_entries = self.count()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, max_entries=100000, db_file=''):
+    """
+    Return the process-wide cache with the given name, max_entries and db_file are used when the cache is created
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = LRUCache(max_entries, db_file)
+        return _caches[name]
+
+
+def get_stats():
+    with _caches_lock:
+        return dict([(name, c.get_stats()) for name, c in _caches.iteritems()])
@@ -1,8 +1,12 @@
 import os
+import heapq
+import shutil
+import hashlib
+import tempfile
 import itertools
-from extractor import Extractor
-from sets import Set
-import utils
+import multiprocessing
+from extractor import extract_apks
+from manifest import Manifest
 
 
 class CorpusWriter(object):
@@ -10,57 +14,203 @@ class CorpusWriter(object):
     OUT_FILENAME = 'strings'
     FOLDER_PARALLEL = 'parallel'
     FOLDER_MONOLINGUAL = 'mono'
+    FOLDER_SHARDS = 'shards'
+    FOLDER_KEYS = 'keys'
+    MANIFEST = 'manifest.json'
+    # Max. number of new lines per corpus file sorted in memory, more lines are sorted in runs written to disk
+    MAX_SORT_LINES = 1000000
 
-    def __init__(self, folder_apks, folder_target, languages, shuffle=True):
+    def __init__(self, folder_apks, folder_target, languages, shuffle=True, workers=1, incremental=True):
         """
         folder_apks -- Absolute path to a folder containing the extracted APKs files, one folder per APK
         folder_target -- Target folder where parallel and monolingual data is written
         languages -- List of languages that should be written
-        shuffle -- If true, shuffle extracted translations for parallel data
+        shuffle -- If true, shuffle extracted translations for parallel data. The order is given by a hash of the APK
+                   and line number, so that the lines of unchanged APKs keep their order in incremental runs.
+        workers -- Number of processes extracting the APKs in parallel, the data is written by a single process
+        incremental -- If true, only extract APKs that changed since the last run, otherwise extract all APKs
         """
         self.folder_apks = folder_apks
         self.folder_target = folder_target
         self.languages = languages
         self.shuffle = shuffle
+        self.workers = workers
+        # The data of each APK is written to its own shard, the shards are concatenated to the corpus files
+        self.folder_shards = os.path.realpath(os.path.join(self.folder_target, self.FOLDER_SHARDS))
+        # Each line of a corpus file has a line "sort key<TAB>APK" in the corresponding keys file, the lines
+        # are ordered by sort key. Merging the lines of changed APKs does not move the other lines.
+        self.folder_keys = os.path.realpath(os.path.join(self.folder_target, self.FOLDER_KEYS))
+        self.manifest = Manifest(os.path.join(self.folder_target, self.MANIFEST))
+        # Shards written for other languages must be rewritten
+        if not incremental or self.manifest.data.get('languages') != sorted(languages) \
+                or self.manifest.data.get('shuffle') != shuffle:
+            self.manifest.clear()
+            for folder in [self.FOLDER_SHARDS, self.FOLDER_KEYS, self.FOLDER_MONOLINGUAL, self.FOLDER_PARALLEL]:
+                folder = os.path.realpath(os.path.join(self.folder_target, folder))
+                if os.path.isdir(folder):
+                    shutil.rmtree(folder)
+        self.manifest.data['languages'] = sorted(languages)
+        self.manifest.data['shuffle'] = shuffle
 
     def write(self):
-        folder_parallel = os.path.realpath(os.path.join(self.folder_target, self.FOLDER_PARALLEL))
-        langs_written = Set()
-        for folder_apk in os.listdir(self.folder_apks):
-            if folder_apk[0] == '.':
-                continue
-            extractor = Extractor(os.path.realpath(os.path.join(self.folder_apks, folder_apk)))
-            translations = extractor.extract_translations()
+        changed, removed = self.manifest.get_changes(self.folder_apks)
+        print '%d new or changed APKs, %d removed APKs' % (len(changed), len(removed))
+        # Corpus files containing lines of the affected APKs, None if unknown (all files are merged)
+        touched = set()
+        for folder_apk in changed + removed:
+            entry = self.manifest.get(folder_apk)
+            if entry is not None and touched is not None:
+                touched = touched | set(entry['paths']) if 'paths' in entry else None
+        for folder_apk in removed:
+            self._remove_shard(folder_apk)
+            self.manifest.remove(folder_apk)
+        for folder_apk, _, translations in extract_apks(self.folder_apks, self.workers, changed):
+            self._remove_shard(folder_apk)
+            folder_shard = os.path.join(self.folder_shards, folder_apk)
             print 'Write monolingual data for app ' + folder_apk
-            self._write_monolingual(translations)
+            self._write_monolingual(translations, os.path.join(folder_shard, self.FOLDER_MONOLINGUAL))
             print 'Write parallel data for app ' + folder_apk
             langs_available = translations.keys()
             langs = sorted([lang for lang in langs_available if lang in self.languages])
             # We need at least 2 supported languages to create parallel data
-            if len(langs) <= 1:
-                continue
-            language_pairs = list(itertools.combinations(langs, 2))
-            # print language_pairs
-            self._write_parallel(translations, folder_parallel, language_pairs)
-            for pairs in language_pairs:
-                langs_written.add(pairs)
-        if self.shuffle:
-            for langs in langs_written:
-                folder = langs[0] + '-' + langs[1]
-                file1 = os.path.join(folder_parallel, folder, self.OUT_FILENAME + '.' + langs[0])
-                file2 = os.path.join(folder_parallel, folder, self.OUT_FILENAME + '.' + langs[1])
-                utils.shuffle_files(file1, file2)
-
-
-    def _write_monolingual(self, translations):
-        folder = os.path.realpath(os.path.join(self.folder_target, self.FOLDER_MONOLINGUAL))
+            if len(langs) > 1:
+                language_pairs = list(itertools.combinations(langs, 2))
+                self._write_parallel(translations, os.path.join(folder_shard, self.FOLDER_PARALLEL), language_pairs)
+            self.manifest.update(os.path.join(self.folder_apks, folder_apk), paths=self._get_shard_paths(folder_apk))
+            if touched is not None:
+                touched.update(self._get_shard_paths(folder_apk))
+        self._merge_shards(set(changed) | set(removed), touched)
+        self.manifest.save()
+
+    def _merge_shards(self, affected, touched):
+        """
+        Update the monolingual and parallel files: Lines of the affected (changed or removed) APKs are dropped and
+        the lines of their new shards are merged in by sort key. Corpus files without keys (e.g. deleted) are
+        rewritten from all shards.
+        affected -- Set of the changed and removed APKs
+        touched -- Set of the corpus files (relative paths) having lines of affected APKs, None to check all files
+        """
+        # Relative paths of the corpus files (e.g. parallel/en-fr/strings.en) and the APKs having a shard of them
+        paths = {}
+        shards = sorted(os.listdir(self.folder_shards)) if os.path.isdir(self.folder_shards) else []
+        for shard in shards:
+            for path in self._get_shard_paths(shard):
+                paths.setdefault(path, []).append(shard)
+        if os.path.isdir(self.folder_keys):
+            for dir_path, _, filenames in os.walk(self.folder_keys):
+                for filename in filenames:
+                    if not filename.endswith('.tmp'):
+                        paths.setdefault(os.path.relpath(os.path.join(dir_path, filename), self.folder_keys), [])
+        for path in sorted(paths):
+            file_corpus = os.path.join(self.folder_target, path)
+            file_keys = os.path.join(self.folder_keys, path)
+            if os.path.isfile(file_corpus) and os.path.isfile(file_keys):
+                if not affected or (touched is not None and path not in touched):
+                    continue
+                apks = [apk for apk in paths[path] if apk in affected]
+                old = self._read_corpus(file_corpus, file_keys, affected)
+            else:
+                apks = paths[path]
+                old = iter([])
+            print 'Merge %d APKs into %s' % (len(apks), path)
+            self._merge_file(path, apks, old)
+
+    def _merge_file(self, path, apks, old):
+        """
+        Write the corpus file and its keys, merging the (sorted) old lines with the lines of the given APK shards
+        """
+        file_corpus = os.path.join(self.folder_target, path)
+        file_keys = os.path.join(self.folder_keys, path)
+        for folder in [os.path.dirname(file_corpus), os.path.dirname(file_keys)]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        dir_temp = tempfile.mkdtemp(dir=self.folder_target)
+        runs = []
+        try:
+            lines = []
+            for apk in apks:
+                with open(os.path.join(self.folder_shards, apk, path)) as f:
+                    for i, line in enumerate(f):
+                        lines.append((self._get_sort_key(path, apk, i), apk, line))
+                if len(lines) >= self.MAX_SORT_LINES:
+                    runs.append(self._write_run(lines, dir_temp, len(runs)))
+                    lines = []
+            lines.sort()
+            n_lines = 0
+            with open(file_corpus + '.tmp', 'w') as f_corpus:
+                with open(file_keys + '.tmp', 'w') as f_keys:
+                    for key, apk, line in heapq.merge(old, iter(lines), *[self._read_run(run) for run in runs]):
+                        f_corpus.write(line)
+                        f_keys.write(key + '\t' + apk + '\n')
+                        n_lines += 1
+        finally:
+            shutil.rmtree(dir_temp)
+        if n_lines:
+            os.rename(file_corpus + '.tmp', file_corpus)
+            os.rename(file_keys + '.tmp', file_keys)
+        else:
+            for path in [file_corpus, file_keys]:
+                os.remove(path + '.tmp')
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def _get_shard_paths(self, folder_apk):
+        """
+        Return the relative paths of the corpus files the APK has lines for
+        """
+        folder_shard = os.path.join(self.folder_shards, folder_apk)
+        paths = []
+        for dir_path, _, filenames in os.walk(folder_shard):
+            paths += [os.path.relpath(os.path.join(dir_path, filename), folder_shard) for filename in filenames]
+        return sorted(paths)
+
+    def _get_sort_key(self, path, apk, i):
+        if self.shuffle and path.startswith(self.FOLDER_PARALLEL + os.sep):
+            # Both files of a language pair get the same keys, their lines stay aligned
+            return hashlib.md5(apk + '\t' + str(i)).hexdigest()
+        return apk + '/%010d' % i
+
+    @staticmethod
+    def _read_corpus(file_corpus, file_keys, affected):
+        """
+        Yield tuples (sort key, APK, line) of a corpus file, skipping the lines of the affected APKs
+        """
+        with open(file_corpus) as f_corpus:
+            with open(file_keys) as f_keys:
+                for line, key in itertools.izip(f_corpus, f_keys):
+                    key, apk = key.rstrip('\n').rsplit('\t', 1)
+                    if apk not in affected:
+                        yield key, apk, line
+
+    @staticmethod
+    def _write_run(lines, dir_temp, i):
+        lines.sort()
+        run = os.path.join(dir_temp, str(i))
+        with open(run, 'w') as f:
+            for key, apk, line in lines:
+                f.write(key + '\t' + apk + '\t' + line)
+        return run
+
+    @staticmethod
+    def _read_run(run):
+        with open(run) as f:
+            for line in f:
+                key, apk, line = line.split('\t', 2)
+                yield key, apk, line
+
+    def _remove_shard(self, folder_apk):
+        folder_shard = os.path.join(self.folder_shards, folder_apk)
+        if os.path.isdir(folder_shard):
+            shutil.rmtree(folder_shard)
+
+    def _write_monolingual(self, translations, folder):
         if not os.path.isdir(folder):
             os.makedirs(folder)
         for language in translations:
             if language not in self.languages:
                 continue
             file_mono = os.path.realpath(os.path.join(folder, self.OUT_FILENAME + '.' + language))
-            f = open(file_mono, 'a')
+            f = open(file_mono, 'w')
             if translations[language]:
                 for key in translations[language]:
                     value = translations[language][key]
@@ -81,13 +231,13 @@ class CorpusWriter(object):
             if len(translations[first_lang]) >= len(translations[second_lang]):
                 primary_lang = translations[first_lang]
                 secondary_lang = translations[second_lang]
-                f1 = open(file1, 'a')
-                f2 = open(file2, 'a')
+                f1 = open(file1, 'w')
+                f2 = open(file2, 'w')
             else:
                 primary_lang = translations[second_lang]
                 secondary_lang = translations[first_lang]
-                f1 = open(file2, 'a')
-                f2 = open(file1, 'a')
+                f1 = open(file2, 'w')
+                f2 = open(file1, 'w')
             for key in primary_lang:
                 if key in secondary_lang:
                     # Both key exists, we can write the parallel data
@@ -104,7 +254,7 @@ if __name__ == '__main__':
     import sys
     import getopt
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'i:o:l', ['in=', 'out=', 'languages='])
+        opts, args = getopt.getopt(sys.argv[1:], 'i:o:l:w:f', ['in=', 'out=', 'languages=', 'workers=', 'full'])
     except getopt.GetoptError as err:
         print str(err)
         sys.exit(2)
@@ -113,6 +263,8 @@ if __name__ == '__main__':
     folder_in = os.path.dirname(os.path.realpath(__file__)) + '/../data/translations_extracted'
     folder_out = os.path.dirname(os.path.realpath(__file__)) + '/../data/corpus'
     languages = ['en', 'fr', 'de']
+    workers = multiprocessing.cpu_count()
+    incremental = True
 
     for opt, arg in opts:
         if opt in ('-i', '--in'):
@@ -121,6 +273,10 @@ if __name__ == '__main__':
             folder_out = arg
         if opt in ('-l', '--languages'):
             languages = arg.split(',')
+        if opt in ('-w', '--workers'):
+            workers = int(arg)
+        if opt in ('-f', '--full'):
+            incremental = False
 
-    writer = CorpusWriter(folder_in, folder_out, languages)
+    writer = CorpusWriter(folder_in, folder_out, languages, workers=workers, incremental=incremental)
     writer.write()
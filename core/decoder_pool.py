@@ -0,0 +1,258 @@
+import os
+import subprocess
+import threading
+import time
+import collections
+import shlex
+import Queue
+import utils
+
+
+class DecoderError(Exception):
+    pass
+
+
+class DecoderTimeout(DecoderError):
+    pass
+
+
+class DecoderProcess(object):
+    """
+    A long-running decoder process (e.g. Moses) translating one line read from stdin into one line written to stdout.
+    The process is started once and keeps its models loaded in memory between requests.
+    """
+
+    # Number of lines from stderr kept in memory, used as debug information
+    MAX_STDERR_LINES = 2000
+
+    def __init__(self, cmd, timeout=300):
+        """
+        cmd -- Command starting the decoder, the decoder must read sentences from stdin and write translations to stdout
+        timeout -- Max. number of seconds a translation may take before the process is killed
+        """
+        self.cmd = cmd
+        self.timeout = timeout
+        self.process = None
+        self.stderr = collections.deque(maxlen=self.MAX_STDERR_LINES)
+        self.n_restarts = 0
+
+    def start(self):
+        self.stderr.clear()
+        self.process = subprocess.Popen(shlex.split(self.cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, close_fds=True)
+        # Drain stderr continuously, otherwise a verbose decoder blocks once the pipe buffer is full
+        thread = threading.Thread(target=self._read_stderr, args=(self.process,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.n_restarts += 1
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def get_pid(self):
+        return self.process.pid if self.is_alive() else 0
+
+    def get_memory(self):
+        """
+        Return the resident memory of the process in bytes, 0 if the process is not running
+        """
+        pid = self.get_pid()
+        if not pid:
+            return 0
+        try:
+            with open('/proc/%s/statm' % pid) as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def translate(self, strings):
+        """
+        Send the given strings to the decoder and return a tuple (translations, debug)
+        """
+        # Health check: start the process on first use and restart it if it died while idle
+        if self.process is None:
+            self.start()
+        elif not self.is_alive():
+            self.restart()
+        self.stderr.clear()
+        process = self.process
+        # Write input in a separate thread, the decoder may fill the stdout pipe before all input is written
+        writer = threading.Thread(target=self._write_stdin, args=(process, strings))
+        writer.daemon = True
+        writer.start()
+        timed_out = threading.Event()
+        timer = threading.Timer(self.timeout, self._kill, args=(process, timed_out))
+        timer.start()
+        try:
+            translations = []
+            for _ in strings:
+                line = process.stdout.readline()
+                if not line and timed_out.is_set():
+                    raise DecoderTimeout("Decoder '%s' did not finish within %d seconds" % (self.cmd, self.timeout))
+                if not line:
+                    raise DecoderError("Decoder '%s' terminated unexpectedly" % self.cmd)
+                translations.append(line.rstrip('\n').strip())
+        finally:
+            timer.cancel()
+        writer.join()
+        return translations, '\n'.join(self.stderr)
+
+    @staticmethod
+    def _kill(process, timed_out):
+        timed_out.set()
+        process.kill()
+
+    @staticmethod
+    def _write_stdin(process, strings):
+        try:
+            for string in strings:
+                # The decoder expects exactly one sentence per line
+                process.stdin.write(' '.join(utils.to_utf8(string).split()) + '\n')
+            process.stdin.flush()
+        except IOError:
+            # Broken pipe, the reading side notices that the process died
+            pass
+
+    def _read_stderr(self, process):
+        for line in iter(process.stderr.readline, ''):
+            if process is self.process:
+                self.stderr.append(line.rstrip('\n'))
+
+
+class DecoderPool(object):
+    """
+    Pool of warm decoder processes sharing the same command (i.e. the same model and settings)
+    """
+
+    def __init__(self, cmd, size=1, timeout=300):
+        """
+        cmd -- Command starting a decoder process
+        size -- Number of processes in the pool, each process can serve one request at a time
+        timeout -- Max. number of seconds a single request may take
+        """
+        self.cmd = cmd
+        self.size = size
+        self.timeout = timeout
+        self.workers = Queue.Queue()
+        self.processes = []
+        self.last_used = time.time()
+        # Number of running requests and whether the pool was evicted, both guarded by _pools_lock
+        self.active = 0
+        self.closed = False
+        for _ in range(size):
+            process = DecoderProcess(cmd, timeout)
+            self.processes.append(process)
+            self.workers.put(process)
+
+    def translate(self, strings):
+        """
+        Translate the given strings with the next idle process of the pool, returns a tuple (translations, debug)
+        A crashed process is restarted and the request is retried once. A process exceeding the timeout is
+        restarted as well, but the request is not retried, it would most likely time out again.
+        """
+        if not len(strings):
+            return [], ''
+        with _pools_lock:
+            closed = self.closed
+            if not closed:
+                self.active += 1
+        if closed:
+            # The pool was evicted after the caller got it, use the pool now registered for the command
+            return get_pool(self.cmd, self.size, self.timeout).translate(strings)
+        self.last_used = time.time()
+        worker = None
+        try:
+            worker = self.workers.get()
+            return worker.translate(strings)
+        except DecoderTimeout:
+            worker.restart()
+            raise
+        except DecoderError:
+            worker.restart()
+            try:
+                return worker.translate(strings)
+            except DecoderError:
+                worker.stop()
+                raise
+        finally:
+            if worker is not None:
+                self.workers.put(worker)
+            with _pools_lock:
+                self.active -= 1
+
+    def stop(self):
+        for process in self.processes:
+            process.stop()
+
+    def is_idle(self):
+        """
+        True if no request is using the pool, call it while holding _pools_lock
+        """
+        return not self.active
+
+    def get_memory(self):
+        return sum([p.get_memory() for p in self.processes])
+
+    def get_status(self):
+        return {
+            'cmd': self.cmd,
+            'size': self.size,
+            'alive': len([p for p in self.processes if p.is_alive()]),
+            'restarts': sum([p.n_restarts for p in self.processes]),
+            'memory': self.get_memory(),
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(cmd, size=1, timeout=300, memory_budget=0):
+    """
+    Return the process-wide pool for the given decoder command, the pool is created on first access
+    cmd -- Command starting a decoder process
+    size -- Number of processes in the pool
+    timeout -- Max. number of seconds a single request may take
+    memory_budget -- Max. resident memory of all pools in MB (0 = unlimited). If exceeded, the least recently
+                     used idle pools are stopped
+    """
+    with _pools_lock:
+        if cmd not in _pools:
+            _pools[cmd] = DecoderPool(cmd, size, timeout)
+        pool = _pools[cmd]
+        pool.last_used = time.time()
+        if memory_budget:
+            _evict(memory_budget * 1024 * 1024)
+        return pool
+
+
+def get_status():
+    with _pools_lock:
+        return [pool.get_status() for pool in _pools.values()]
+
+
+def _evict(memory_budget):
+    memory = dict([(cmd, pool.get_memory()) for cmd, pool in _pools.iteritems()])
+    total = sum(memory.values())
+    # The most recently used pool (the one requested) is never evicted
+    candidates = sorted(_pools.values(), key=lambda p: p.last_used)[:-1]
+    for pool in candidates:
+        if total <= memory_budget:
+            break
+        if not pool.is_idle() or not memory[pool.cmd]:
+            continue
+        # Callers still holding the pool notice that it is closed and fetch a new one
+        pool.closed = True
+        pool.stop()
+        del _pools[pool.cmd]
+        total -= memory[pool.cmd]
@@ -3,6 +3,8 @@ import re
 import xml.etree.ElementTree as ElementTree
 from HTMLParser import HTMLParser
 import shutil
+import multiprocessing
+import collections
 
 class Extractor(object):
 
@@ -40,6 +42,43 @@ class Extractor(object):
         return e.extract()
 
 
+def extract_apks(folder_apks, workers=1, folders=None):
+    """
+    Extract the translations of all APKs in the given folder, one folder per APK
+    folder_apks -- Path to a folder containing extracted APK files
+    workers -- Number of processes parsing the APKs in parallel
+    folders -- Names of the APK folders to extract, defaults to all folders
+
+    Yields tuples (folder, app_id, translations) in the order of the folders, so that a single consumer can write
+    the results without interleaving output of different APKs
+    """
+    folders = [f for f in os.listdir(folder_apks) if f[0] != '.'] if folders is None else folders
+    folders = [os.path.join(folder_apks, f) for f in folders]
+    if workers <= 1:
+        for folder_apk in folders:
+            yield _extract_apk(folder_apk)
+        return
+    pool = multiprocessing.Pool(workers)
+    # Bound the number of pending results, so that workers cannot run ahead of a slow consumer
+    pending = collections.deque()
+    try:
+        for folder_apk in folders:
+            pending.append(pool.apply_async(_extract_apk, (folder_apk,)))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _extract_apk(folder_apk):
+    ext = Extractor(os.path.realpath(folder_apk))
+    return os.path.basename(folder_apk), ext.extract_app_id(), ext.extract_translations()
+
+
 class ExtractTranslationsFromXML(object):
 
     def __init__(self, xml_file):
@@ -81,6 +120,44 @@ class ExtractTranslationsFromXML(object):
             self.error_recursion_level += 1
             return self.extract()
 
+    def iterextract(self):
+        """
+        Same as extract, but parses the xml file incrementally and yields the translations as tuples (key, value)
+        in the order of the file. Memory usage does not grow with the size of the file.
+        """
+        if not os.path.isfile(self.xml_file):
+            return
+        keys = set()
+        try:
+            depth = 0
+            parser = ElementTree.XMLParser(encoding='utf-8')
+            for event, trans in ElementTree.iterparse(self.xml_file, events=('start', 'end'), parser=parser):
+                if event == 'start':
+                    if depth == 0:
+                        root = trans
+                    depth += 1
+                    continue
+                depth -= 1
+                # Only direct children of the root element contain translations
+                if depth != 1:
+                    continue
+                key = trans.attrib.get('name')
+                text = trans.text
+                # Remove processed elements from the tree
+                root.clear()
+                if not key or not text:
+                    continue
+                value = self.sanitizer.sanitize(text.encode('utf-8'))
+                if not value:
+                    continue
+                keys.add(key)
+                yield key, value
+        except ElementTree.ParseError:
+            # Fall back to extract, which removes invalid lines, and yield the translations not yet returned
+            for key, value in self.extract().iteritems():
+                if key not in keys:
+                    yield key, value
+
 
 class TranslationStringSanitizer(object):
 
@@ -0,0 +1,168 @@
+import os
+import mmap
+import json
+import math
+
+"""
+Cross validation folds of a parallel corpus, without copying the data of each run.
+
+A fold index (JSON) describes how the lines of a shuffled, aligned corpus (one file per language) are split into
+parts, and which parts are used for training, testing and development in each run. Each part is stored as range of
+byte offsets per language file, the files are read through mmap. Writing the files of a run is optional,
+see Folds.materialize().
+
+Format of the index:
+{
+    'files': {'en': 'strings.clean.en', 'fr': 'strings.clean.fr'},  # Relative to the directory of the index
+    'lines': 1000,
+    'parts': [{'lines': [0, 200], 'offsets': {'en': [0, 8123], 'fr': [0, 9011]}}, ...],
+    'runs': {'1': {'train': [1, 2, 3, 4, 5], 'test': [0], 'dev': [5]}, ...}  # Indexes of parts
+}
+
+@author Stefan Wanzenried <stefan.wanzenried@gmail.com>
+"""
+
+INDEX_FILENAME = 'folds.json'
+SPLITS = ['train', 'test', 'dev']
+
+
+class Folds(object):
+    """
+    Read access to the runs of a fold index
+    """
+
+    def __init__(self, index_file):
+        if not os.path.isfile(index_file):
+            raise Exception("Fold index '" + index_file + "' does not exist")
+        with open(index_file) as f:
+            self.index = json.load(f)
+        self.dir = os.path.dirname(os.path.realpath(index_file))
+        self.maps = {}
+
+    def get_runs(self):
+        return sorted([int(run) for run in self.index['runs']])
+
+    def get_languages(self):
+        return sorted(self.index['files'].keys())
+
+    def get_ranges(self, run, split, lang):
+        """
+        Return the byte ranges [(start, end), ...] of the lines of a run and split ('train', 'test' or 'dev') in the
+        file of the given language. Ranges of adjacent parts are merged.
+        """
+        ranges = []
+        for part in self.index['runs'][str(run)][split]:
+            start, end = self.index['parts'][part]['offsets'][lang]
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def get_lines(self, run, split, lang):
+        """
+        Yield the lines (including the line break) of a run and split in the given language
+        """
+        data = self._get_map(lang)
+        for start, end in self.get_ranges(run, split, lang):
+            pos = start
+            while pos < end:
+                newline = data.find('\n', pos, end)
+                stop = end if newline < 0 else newline + 1
+                yield data[pos:stop]
+                pos = stop
+
+    def materialize(self, run, dir_run, dev_filename='strings-dev.clean'):
+        """
+        Write the files strings-train.clean.<lang>, strings-test.clean.<lang> and <dev_filename>.<lang> of a run
+        """
+        if not os.path.isdir(dir_run):
+            os.makedirs(dir_run)
+        filenames = {'train': 'strings-train.clean', 'test': 'strings-test.clean', 'dev': dev_filename}
+        for split in SPLITS:
+            if not self.index['runs'][str(run)][split]:
+                continue
+            for lang in self.get_languages():
+                data = self._get_map(lang)
+                with open(os.path.join(dir_run, filenames[split] + '.' + lang), 'w') as f:
+                    for start, end in self.get_ranges(run, split, lang):
+                        for offset in xrange(start, end, 16 * 1024 ** 2):
+                            f.write(data[offset:min(end, offset + 16 * 1024 ** 2)])
+
+    def close(self):
+        for data in self.maps.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.maps = {}
+
+    def _get_map(self, lang):
+        if lang not in self.maps:
+            path = os.path.join(self.dir, self.index['files'][lang])
+            with open(path, 'rb') as f:
+                # Empty files cannot be mapped
+                self.maps[lang] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else ''
+        return self.maps[lang]
+
+
+def write_folds(files, parts, dev, index_file):
+    """
+    Split aligned files into parts of (almost) equal size and write the fold index. Run k uses part k for testing
+    and all other parts for training. If dev is true, the last part is the development set of all runs and there is
+    no run testing it, note that it is part of the training data as well (same as the files written before).
+    files -- Dictionary language => path of a shuffled file, all files must have the same number of lines
+    parts -- Number of parts, including the development set
+    dev -- If true, use the last part as development set
+    index_file -- Path of the fold index, the files must be in the same directory
+    """
+    dir_index = os.path.dirname(os.path.realpath(index_file))
+    n_lines = None
+    for path in files.values():
+        if os.path.dirname(os.path.realpath(path)) != dir_index:
+            raise Exception("'" + path + "' is not in the directory of the fold index")
+        with open(path, 'rb') as f:
+            n = sum(1 for _ in f)
+        if n_lines is not None and n != n_lines:
+            raise Exception("The files of the fold index do not have the same number of lines")
+        n_lines = n
+    lines_per_part = max(1, int(math.ceil(n_lines / float(parts))))
+    boundaries = range(0, n_lines, lines_per_part) + [n_lines]
+    offsets = dict([(lang, _get_offsets(path, boundaries)) for lang, path in files.iteritems()])
+    index = {
+        'files': dict([(lang, os.path.basename(path)) for lang, path in files.iteritems()]),
+        'lines': n_lines,
+        'parts': [],
+        'runs': {},
+    }
+    for i in range(len(boundaries) - 1):
+        index['parts'].append({
+            'lines': [boundaries[i], boundaries[i + 1]],
+            'offsets': dict([(lang, [offsets[lang][i], offsets[lang][i + 1]]) for lang in files]),
+        })
+    n_parts = len(index['parts'])
+    n_runs = n_parts - 1 if dev else n_parts
+    for run in range(1, n_runs + 1):
+        index['runs'][str(run)] = {
+            'train': [part for part in range(n_parts) if part != run - 1],
+            'test': [run - 1],
+            'dev': [n_parts - 1] if dev else [],
+        }
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(index_file + '.tmp', index_file)
+    return index
+
+
+def _get_offsets(path, line_numbers):
+    """
+    Return the byte offsets of the given (sorted) line numbers of a file, the number of lines maps to the file size
+    """
+    offsets = []
+    i = 0
+    offset = 0
+    with open(path, 'rb') as f:
+        for n, line in enumerate(f):
+            while i < len(line_numbers) and line_numbers[i] == n:
+                offsets.append(offset)
+                i += 1
+            offset += len(line)
+    return offsets + [offset] * (len(line_numbers) - i)
@@ -0,0 +1,123 @@
+import threading
+import collections
+import traceback
+import uuid
+import time
+import Queue
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job(object):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, decoder, func, args):
+        """
+        decoder -- Decoder type running the job, e.g. 'moses'
+        func -- Function executing the job, its return value is the result of the job
+        args -- Arguments passed to func
+        """
+        self.id = uuid.uuid4().hex
+        self.decoder = decoder
+        self.func = func
+        self.args = args
+        self.status = self.QUEUED
+        self.result = None
+        self.error = ''
+        self.created = time.time()
+        self.started = 0
+        self.finished = 0
+
+    def run(self):
+        self.status = self.RUNNING
+        self.started = time.time()
+        try:
+            self.result = self.func(*self.args)
+            self.status = self.DONE
+        except Exception as e:
+            self.error = str(e)
+            self.result = {'debug': traceback.format_exc()}
+            self.status = self.FAILED
+        self.finished = time.time()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'decoder': self.decoder,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'result': self.result,
+        }
+
+
+class JobQueue(object):
+    """
+    Runs translation jobs in background threads. Each decoder type has its own queue and a limited number of
+    worker threads, so that slow decoders cannot block the jobs of the other ones.
+    """
+
+    def __init__(self, decoders, workers={}, max_queued=100, max_finished=1000):
+        """
+        decoders -- List of the valid decoder types, each one gets its own queue and worker threads
+        workers -- Dictionary decoder type => number of worker threads, decoders not listed get one worker
+        max_queued -- Max. number of queued jobs per decoder type, further jobs are rejected
+        max_finished -- Max. number of finished jobs kept, the oldest ones are removed
+        """
+        self.decoders = decoders
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.queues = {}
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, decoder, func, *args):
+        """
+        Queue a new job and return it, raises JobQueueFull if too many jobs of the decoder are waiting
+        """
+        if decoder not in self.decoders:
+            raise ValueError("Unknown decoder '%s'" % decoder)
+        job = Job(decoder, func, args)
+        queue = self._get_queue(decoder)
+        try:
+            queue.put_nowait(job)
+        except Queue.Full:
+            raise JobQueueFull("Too many queued jobs for decoder '%s'" % decoder)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._cleanup()
+        return job
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def _get_queue(self, decoder):
+        with self.lock:
+            if decoder not in self.queues:
+                self.queues[decoder] = Queue.Queue(self.max_queued)
+                for _ in range(self.workers.get(decoder, 1)):
+                    thread = threading.Thread(target=self._work, args=(self.queues[decoder],))
+                    thread.daemon = True
+                    thread.start()
+            return self.queues[decoder]
+
+    def _cleanup(self):
+        finished = [id for id, job in self.jobs.iteritems() if job.status in (Job.DONE, Job.FAILED)]
+        for id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[id]
+
+    @staticmethod
+    def _work(queue):
+        while True:
+            job = queue.get()
+            job.run()
+            queue.task_done()
@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+
+
+class Manifest(object):
+    """
+    Records a content hash per APK folder, so that reruns only need to process new or changed APKs.
+    The hash of an APK covers its AndroidManifest.xml and the strings.xml files in res/. The mtime and size of each
+    file are recorded as well, a file is only hashed again if one of them changed.
+
+    Each entry may hold additional data of the consumer, e.g. which files were written for the APK.
+    """
+
+    def __init__(self, manifest_file):
+        """
+        manifest_file -- Path to the JSON file storing the manifest, created on save() if it does not exist
+        """
+        self.manifest_file = manifest_file
+        self.entries = {}
+        self.data = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            self.entries = manifest['entries']
+            self.data = manifest['data']
+
+    def get_changes(self, folder_apks):
+        """
+        Return a tuple (changed, removed) containing the names of the APK folders being new or changed since their
+        last update(), and of the recorded APK folders which no longer exist
+        """
+        folders = set([f for f in os.listdir(folder_apks) if f[0] != '.'])
+        changed = []
+        for folder in sorted(folders):
+            entry = self.entries.get(folder)
+            if entry is None or self._hash_files(os.path.join(folder_apks, folder), entry['files'])[0] != entry['hash']:
+                changed.append(folder)
+        removed = sorted(set(self.entries.keys()) - folders)
+        return changed, removed
+
+    def get(self, folder):
+        return self.entries.get(folder)
+
+    def update(self, folder_apk, **data):
+        """
+        Record the current hash of the given APK folder together with the given data, call it once the APK is
+        processed. Data of previous updates is kept unless overwritten.
+        """
+        name = os.path.basename(folder_apk.rstrip('/'))
+        entry = self.entries.get(name, {})
+        entry['hash'], entry['files'] = self._hash_files(folder_apk, entry.get('files', {}))
+        entry.update(data)
+        self.entries[name] = entry
+        return entry
+
+    def remove(self, folder):
+        return self.entries.pop(folder, None)
+
+    def clear(self):
+        self.entries = {}
+        self.data = {}
+
+    def save(self):
+        dir_manifest = os.path.dirname(os.path.realpath(self.manifest_file))
+        if not os.path.isdir(dir_manifest):
+            os.makedirs(dir_manifest)
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump({'entries': self.entries, 'data': self.data}, f)
+        os.rename(self.manifest_file + '.tmp', self.manifest_file)
+
+    @staticmethod
+    def get_files(folder_apk):
+        """
+        Return the paths of the files of an APK folder that are relevant for the extraction, relative to the folder
+        """
+        files = ['AndroidManifest.xml'] if os.path.isfile(os.path.join(folder_apk, 'AndroidManifest.xml')) else []
+        folder_res = os.path.join(folder_apk, 'res')
+        if os.path.isdir(folder_res):
+            for folder_value in sorted(os.listdir(folder_res)):
+                path = os.path.join('res', folder_value, 'strings.xml')
+                if folder_value[0] != '.' and os.path.isfile(os.path.join(folder_apk, path)):
+                    files.append(path)
+        return files
+
+    def _hash_files(self, folder_apk, known):
+        """
+        Return a tuple (hash, files) where files is a dictionary path => [mtime, size, md5] of the APK's files and
+        hash is computed over the hashes of all files. Hashes of files with unchanged mtime and size are reused.
+        """
+        files = {}
+        md5 = hashlib.md5()
+        for path in self.get_files(folder_apk):
+            stat = os.stat(os.path.join(folder_apk, path))
+            if path in known and known[path][0] == stat.st_mtime and known[path][1] == stat.st_size:
+                file_hash = known[path][2]
+            else:
+                file_hash = self._hash_file(os.path.join(folder_apk, path))
+            files[path] = [stat.st_mtime, stat.st_size, file_hash]
+            md5.update(path + '\t' + file_hash + '\n')
+        return md5.hexdigest(), files
+
+    @staticmethod
+    def _hash_file(path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), ''):
+                md5.update(block)
+        return md5.hexdigest()
@@ -0,0 +1,254 @@
+import os
+import re
+import sys
+import mmap
+import json
+import struct
+import getopt
+import hashlib
+import operator
+import threading
+import xml.etree.ElementTree as ElementTree
+import utils
+
+"""
+Build a local phrase index mapping normalized strings of a source language to the aligned strings of a target
+language, together with their counts. The index is a file that is memory-mapped for lookups, so that the Solr
+baseline system can find translations without sending requests to Solr.
+
+Usage:
+$ python phrase_index.py --source_lang=en --target_lang=fr --xml_dir=/path/to/solr_xml
+$ python phrase_index.py --source_lang=en --target_lang=fr --files=/path/to/strings.en,/path/to/strings.fr
+
+Arguments:
+--source_lang       Source language
+--target_lang       Target language
+--xml_dir           Directory containing the Solr XML files written by translations2solr.py, one folder per language
+--files             Alternative to xml_dir: Two aligned files (one string per line) of the source and target language
+--output            Path of the index file (default='data/index/<source_lang>-<target_lang>.idx')
+
+@author Stefan Wanzenried <stefan.wanzenried@gmail.com>
+"""
+
+
+class PhraseIndex(object):
+    """
+    Read-only, memory-mapped phrase index.
+
+    File format: A header (magic, version, number of records), followed by the records sorted by hash (64 bit hash
+    of the normalized source string, offset and length of the entry) and the entries. An entry is a JSON list
+    [source, [[target, count], ...]] with the translations sorted by count.
+    """
+
+    MAGIC = 'APTI'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQ')
+    RECORD = struct.Struct('<QQI')
+
+    def __init__(self, index_file):
+        if not os.path.isfile(index_file):
+            raise Exception("Phrase index '" + index_file + "' does not exist")
+        self.index_file = index_file
+        with open(index_file, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_records = self.HEADER.unpack_from(self.data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise Exception("'" + index_file + "' is not a valid phrase index")
+
+    def get_translations(self, string):
+        """
+        Return the translations of the given string sorted by count, same format as returned by the Solr baseline
+        [{'value': 'Translation', 'count': 10}, ...]
+        """
+        normalized = self.normalize(string)
+        if not normalized:
+            return []
+        hash = self.hash(normalized)
+        i = self._find(hash)
+        while i < self.n_records:
+            record_hash, offset, length = self._get_record(i)
+            if record_hash != hash:
+                break
+            source, translations = json.loads(self.data[offset:offset + length])
+            if utils.to_utf8(source) == normalized:
+                return [{'value': value, 'count': count} for value, count in translations]
+            i += 1
+        return []
+
+    def close(self):
+        self.data.close()
+
+    def _find(self, hash):
+        """
+        Return the index of the first record having the given hash (or a higher one)
+        """
+        low, high = 0, self.n_records
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_record(middle)[0] < hash:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _get_record(self, i):
+        return self.RECORD.unpack_from(self.data, self.HEADER.size + i * self.RECORD.size)
+
+    @staticmethod
+    def normalize(string):
+        """
+        Normalize a string the way the 'value_lc' field in Solr does: Lowercase words without punctuation
+        """
+        string = utils.to_utf8(string).decode('utf-8', 'replace').lower()
+        return ' '.join(re.split(r'\W+', string, flags=re.UNICODE)).strip().encode('utf-8')
+
+    @staticmethod
+    def hash(normalized):
+        return struct.unpack('<Q', hashlib.md5(normalized).digest()[:8])[0]
+
+
+class PhraseIndexWriter(object):
+    """
+    Collects aligned strings and writes them as phrase index
+    """
+
+    def __init__(self, max_translations=100):
+        """
+        max_translations -- Max. number of translations stored per source string, the most frequent ones are kept
+        """
+        self.max_translations = max_translations
+        self.counts = {}
+
+    def add(self, source, target):
+        source = PhraseIndex.normalize(source)
+        target = utils.to_utf8(target).lower().strip()
+        if not source or not target:
+            return
+        if source not in self.counts:
+            self.counts[source] = {}
+        self.counts[source][target] = self.counts[source].get(target, 0) + 1
+
+    def add_files(self, file_source, file_target):
+        """
+        Add the strings of two aligned files, the n-th line of the source file is translated by the n-th line of
+        the target file
+        """
+        with open(file_source) as f_source:
+            with open(file_target) as f_target:
+                for source, target in zip(f_source, f_target):
+                    self.add(source, target)
+
+    def add_solr_xml(self, dir_source, dir_target):
+        """
+        Add the strings of Solr XML files, see translations2solr.SolrXMLWriter. Strings are aligned by document ID.
+        """
+        for filename in os.listdir(dir_source):
+            file_target = os.path.join(dir_target, filename)
+            if filename[0] == '.' or not os.path.isfile(file_target):
+                continue
+            sources = self._read_solr_xml(os.path.join(dir_source, filename))
+            targets = self._read_solr_xml(file_target)
+            for id, source in sources.iteritems():
+                if id in targets:
+                    self.add(source, targets[id])
+
+    def write(self, index_file):
+        dir_index = os.path.dirname(os.path.realpath(index_file))
+        if not os.path.isdir(dir_index):
+            os.makedirs(dir_index)
+        entries = []
+        for source, translations in self.counts.iteritems():
+            translations = sorted(translations.items(), key=operator.itemgetter(1), reverse=True)
+            entries.append((PhraseIndex.hash(source), json.dumps([source, translations[:self.max_translations]])))
+        entries.sort(key=operator.itemgetter(0))
+        offset = PhraseIndex.HEADER.size + len(entries) * PhraseIndex.RECORD.size
+        with open(index_file + '.tmp', 'wb') as f:
+            f.write(PhraseIndex.HEADER.pack(PhraseIndex.MAGIC, PhraseIndex.VERSION, len(entries)))
+            for hash, entry in entries:
+                f.write(PhraseIndex.RECORD.pack(hash, offset, len(entry)))
+                offset += len(entry)
+            for _, entry in entries:
+                f.write(entry)
+        os.rename(index_file + '.tmp', index_file)
+
+    @staticmethod
+    def _read_solr_xml(xml_file):
+        values = {}
+        try:
+            for _, doc in ElementTree.iterparse(xml_file):
+                if doc.tag != 'doc':
+                    continue
+                fields = dict([(field.attrib['name'], field.text) for field in doc])
+                if fields.get('id') and fields.get('value'):
+                    values[fields['id']] = fields['value']
+                doc.clear()
+        except ElementTree.ParseError:
+            pass
+        return values
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(index_file):
+    """
+    Return the process-wide instance of the given phrase index, the file is memory-mapped on first access
+    """
+    with _indexes_lock:
+        if index_file not in _indexes:
+            _indexes[index_file] = PhraseIndex(index_file)
+        return _indexes[index_file]
+
+
+def get_index_file(dir_index, source, target):
+    return os.path.join(dir_index, source + '-' + target + '.idx')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:t:x:f:o:', ['source_lang=', 'target_lang=', 'xml_dir=', 'files=', 'output='])
+    except getopt.GetoptError as err:
+        print str(err)
+        sys.exit(2)
+
+    source_lang = ''
+    target_lang = ''
+    xml_dir = ''
+    files = []
+    output = ''
+    for opt, arg in opts:
+        if opt in ('-s', '--source_lang'):
+            source_lang = arg
+        if opt in ('-t', '--target_lang'):
+            target_lang = arg
+        if opt in ('-x', '--xml_dir'):
+            xml_dir = arg
+        if opt in ('-f', '--files'):
+            files = arg.split(',')
+        if opt in ('-o', '--output'):
+            output = arg
+
+    if not source_lang or not target_lang:
+        print "Source and target language are mandatory"
+        sys.exit(2)
+
+    if not output:
+        dir_index = os.path.dirname(os.path.realpath(__file__)) + '/../data/index/'
+        output = get_index_file(dir_index, source_lang, target_lang)
+
+    writer = PhraseIndexWriter()
+    if xml_dir:
+        dir_source = os.path.join(xml_dir, source_lang)
+        dir_target = os.path.join(xml_dir, target_lang)
+        if not os.path.isdir(dir_source) or not os.path.isdir(dir_target):
+            print "Solr XML files for '" + source_lang + "' and '" + target_lang + "' not found in " + xml_dir
+            sys.exit(2)
+        writer.add_solr_xml(dir_source, dir_target)
+    elif len(files) == 2 and os.path.isfile(files[0]) and os.path.isfile(files[1]):
+        writer.add_files(files[0], files[1])
+    else:
+        print "Either --xml_dir or --files containing two existing files is required"
+        sys.exit(2)
+    writer.write(output)
+    print "Wrote %d strings to %s" % (len(writer.counts), output)
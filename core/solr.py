@@ -1,9 +1,15 @@
 import os
 import xml.etree.ElementTree as ElementTree
-import urllib2
 import urllib
-import subprocess
+import urlparse
+import httplib
+import socket
+import threading
+import Queue
+import bisect
+import zlib
 import json
+import time
 import operator
 import utils
 
@@ -15,27 +21,59 @@ class Solr:
     DELIMITER_START = 'SOLR_S'
     DELIMITER_END = 'SOLR_E'
 
-    def __init__(self, dir_solr='', solr_url=''):
+    def __init__(self, dir_solr='', solr_url='', cores_ttl=60):
         """
         dir_solr -- Absolute path to Solr
         solr_url -- URL to Solr
+        cores_ttl -- Number of seconds the list of cores is cached
         """
         self.dir_solr = dir_solr.rstrip(os.sep) + os.sep
         self.solr_url = solr_url.rstrip('/') if solr_url else 'http://localhost:8983'
+        # Connections are shared by all instances accessing the same Solr
+        self.transport = get_transport(self.solr_url)
         # The instance directory storing the index for the different cores
         self.dir_data = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), '../config')), self.SOLR_DATA_DIR) + os.sep
         if not os.path.isdir(self.dir_data):
             os.makedirs(self.dir_data)
-        self.cache_cores = self.get_cores()
+        # Number of HTTP requests sent to Solr by all threads, and per thread (see get_thread_requests())
+        self.n_requests = 0
+        self.requests_lock = threading.Lock()
+        self.local = threading.local()
+        # The cores are fetched on first use, see exists_core()
+        self.cache_cores = None
+        self.core_versions = {}
+        self.cores_ttl = cores_ttl
+        self.cores_loaded = 0
+        self.cores_lock = threading.Lock()
 
 
     def get_cores(self):
         """
         Return a list of active cores, e.g. ['en', 'de', 'fr']
         """
-        xml_response = self._call_solr_core_api({'action': 'STATUS'})
-        xml = ElementTree.parse(xml_response)
-        return [core.attrib['name'] for core in xml.getroot()[2]]
+        return [name for name, _ in self._get_core_status()]
+
+
+    def get_core_version(self, core):
+        """
+        Return the version of the core's index (changes whenever the index is modified), '' if the core does
+        not exist. The version is cached like the list of cores, see _get_cached_cores().
+        """
+        self._get_cached_cores()
+        with self.cores_lock:
+            return self.core_versions.get(core, '')
+
+
+    def _get_core_status(self):
+        """
+        Return a list of tuples (name, index version) of the active cores
+        """
+        xml = ElementTree.fromstring(self._call_solr_core_api({'action': 'STATUS'}))
+        status = []
+        for core in xml[2]:
+            version = core.find("lst[@name='index']/long[@name='version']")
+            status.append((core.attrib['name'], version.text if version is not None else ''))
+        return status
 
 
     def create_core(self, name, configset):
@@ -54,30 +92,75 @@ class Solr:
             'configSet': configset,
         }
 
-        xml_response = self._call_solr_core_api(params)
         # Check XML response for errors, a status=0 indicates that the core was created successfully
-        xml = ElementTree.parse(xml_response)
-        status = int(xml.getroot()[0][0].text)
+        xml = ElementTree.fromstring(self._call_solr_core_api(params))
+        status = int(xml[0][0].text)
         if status == 0:
-            self.cache_cores.append(name)
+            self._get_cached_cores().append(name)
         else:
-            raise Exception(xml.getroot()[1][0].text)  # TODO Check available errors, no docs available?
+            raise Exception(xml[1][0].text)  # TODO Check available errors, no docs available?
 
 
-    def index(self, document, core, configset=''):
+    def index(self, document, core, configset='', indexer=None):
         """
         Index a Solr xml document (or path containing xml documents) into the given core
+        document -- Path to a xml document or directory, or a list of paths
+        indexer -- Instance of SolrIndexer to send the documents, if given the caller is responsible to finish() it.
+                   By default, the documents are sent and committed before returning.
+        Returns the number of indexed documents
         """
         configset = self.CONFIGSET_TRANSLATIONS if not configset else configset
         if not self.exists_core(core):
             self.create_core(core, configset)
-        cmd = self.dir_solr + os.path.join('bin', 'post')
-        result = subprocess.call([cmd, '-c', core, document])
-        return result
+        documents = [document] if isinstance(document, basestring) else document
+        xml_files = []
+        for path in documents:
+            if os.path.isdir(path):
+                xml_files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.xml')]
+            else:
+                xml_files.append(path)
+        finish = indexer is None
+        indexer = SolrIndexer(self.solr_url) if indexer is None else indexer
+        n_docs = 0
+        for xml_file in xml_files:
+            n_docs += indexer.add_xml(core, xml_file)
+        if finish:
+            indexer.finish()
+        return n_docs
+
+
+    def delete_apps(self, core, app_ids):
+        """
+        Delete all documents of the given apps from the core
+        """
+        if not self.exists_core(core):
+            return
+        for chunk in utils.chunks(app_ids, 100):
+            query = 'app_id:(' + ' OR '.join(['"' + utils.to_utf8(app_id) + '"' for app_id in chunk]) + ')'
+            self._call_solr_update_api(core, {'delete': {'query': query}})
+        self._call_solr_update_api(core, {'commit': {}})
 
 
     def exists_core(self, name):
-        return name in self.cache_cores
+        if name in self._get_cached_cores():
+            return True
+        # The core may have been created since the list was fetched
+        return name in self._get_cached_cores(True)
+
+
+    def _get_cached_cores(self, refresh=False):
+        """
+        Return the cached list of cores, fetched again once it is older than cores_ttl seconds
+        refresh -- If true, fetch the cores unless the list was fetched less than a second ago
+        """
+        with self.cores_lock:
+            age = time.time() - self.cores_loaded
+            if self.cache_cores is None or age > self.cores_ttl or (refresh and age > 1):
+                status = self._get_core_status()
+                self.cache_cores = [name for name, _ in status]
+                self.core_versions = dict(status)
+                self.cores_loaded = time.time()
+            return self.cache_cores
 
 
     def get_top_terms(self, core, n=10):
@@ -86,8 +169,7 @@ class Solr:
         """
         if not self.exists_core(core):
             raise Exception("Core '" + core + "' does not exist")
-        req = self._call_solr_api(core + '/terms', {'terms.fl': 'value', 'terms.limit': n})
-        json_response = json.load(req)
+        json_response = self._call_solr_api(core + '/terms', {'terms.fl': 'value', 'terms.limit': n})
         i = 0
         terms = []
         term = {}
@@ -109,15 +191,10 @@ class Solr:
         }
         results = self.query(lang_from, params)
         counts = {}
-        for result in results['docs']:
-            params = {
-                'q': 'app_id:%s AND key:%s' % (result['app_id'], result['key'])
-            }
-            translation = self.query(lang_to, params)
-            if translation['numFound']:
-                value = translation['docs'][0]['value'].lower()
-                value = value.strip()
-                counts[value] = 1 if value not in counts else counts[value] + 1
+        for value in self.get_aligned_values(lang_to, results['docs']):
+            value = value.lower()
+            value = value.strip()
+            counts[value] = 1 if value not in counts else counts[value] + 1
         # Sort dict by counts
         counts_sorted = sorted(counts.items(), key=operator.itemgetter(1), reverse=True)
         variations = []
@@ -128,29 +205,464 @@ class Solr:
             })
         return variations
 
-    def query(self, core, query_params):
+    def get_aligned_values(self, core, docs, batch=True):
+        """
+        Return the values of the documents in the given core having the same app_id and key as the given docs,
+        e.g. the translations of strings from another language. Docs without aligned document are skipped.
+        core -- Core to search for aligned documents
+        docs -- List of documents, each containing the fields 'app_id' and 'key'
+        batch -- If true, fetch all aligned documents with a single request, otherwise send one request per doc
+        """
+        values = []
+        if batch:
+            ids = [self.get_document_id(doc['app_id'], doc['key']) for doc in docs]
+            documents = self.get_documents(core, ids, 'id,value')
+            for id in ids:
+                if id in documents:
+                    values.append(documents[id]['value'])
+            return values
+        for doc in docs:
+            params = {
+                'q': 'app_id:%s AND key:%s' % (doc['app_id'], doc['key'])
+            }
+            result = self.query(core, params)
+            if result['numFound']:
+                values.append(result['docs'][0]['value'])
+        return values
+
+    def get_documents(self, core, ids, fields='*'):
+        """
+        Return the documents having the given IDs with a single request, as dictionary id => document
+        """
+        ids = list(set([utils.to_utf8(id) for id in ids]))
+        if not ids:
+            return {}
+        params = {
+            'q': '{!terms f=id}' + ','.join(ids),
+            'fl': fields,
+            'rows': len(ids)
+        }
+        # The list of IDs may exceed the max. length of an URL
+        results = self.query(core, params, True)
+        return dict([(utils.to_utf8(doc['id']), doc) for doc in results['docs']])
+
+    @staticmethod
+    def get_document_id(app_id, key):
+        return '_'.join([app_id, key])
+
+    def query(self, core, query_params, post=False):
         try:
-            results = json.load(self._call_solr_api(core + '/select', query_params))
+            results = self._call_solr_api(core + '/select', query_params, post)
             results['response']['error'] = False
             return results['response']
-        except urllib2.HTTPError as e:
+        except SolrError as e:
             return {
                 'numFound': 0,
                 'docs': [],
-                'error': e.strerror
+                'error': str(e)
             }
 
 
-    def _call_solr_api(self, endpoint, params):
+    def query_groups(self, core, queries, query_params={}):
+        """
+        Send multiple queries with a single request (POST), each query is a group.query of Solr's result grouping.
+        Returns a dictionary query => results in the same format as query()
+        queries -- List of queries
+        query_params -- Additional params, e.g. {'group.limit': 10} for the max. number of docs per query
+        """
+        params = dict(query_params, **{'q': '*:*', 'group': 'true', 'group.query': list(queries)})
+        try:
+            grouped = self._call_solr_api(core + '/select', params, True)['grouped']
+            results = {}
+            for query in queries:
+                doclist = grouped.get(query, {}).get('doclist', {'numFound': 0, 'docs': []})
+                results[query] = {'numFound': doclist['numFound'], 'docs': doclist['docs'], 'error': False}
+            return results
+        except SolrError as e:
+            return dict([(query, {'numFound': 0, 'docs': [], 'error': str(e)}) for query in queries])
+
+
+    def get_thread_requests(self):
+        """
+        Return the number of requests sent by the calling thread. The instance is shared by concurrent requests,
+        the difference of two calls counts the requests of the code in between.
+        """
+        return getattr(self.local, 'n_requests', 0)
+
+
+    def _count_request(self):
+        with self.requests_lock:
+            self.n_requests += 1
+        self.local.n_requests = getattr(self.local, 'n_requests', 0) + 1
+
+
+    def _call_solr_api(self, endpoint, params, post=False):
         """
         endpoint -- Must contain request handler and core, e.g. select/en or terms/en
         params   -- Dictionary of additional params to send
+        post     -- If true, params are sent in the body of a POST request. Long queries are always sent by POST.
+        Returns the decoded JSON response
         """
         params['wt'] = 'json'
-        # print self.solr_url + '/solr/' + endpoint + '?' + urllib.urlencode(params)
-        return urllib2.urlopen(self.solr_url + '/solr/' + endpoint + '?' + urllib.urlencode(params))
+        self._count_request()
+        if post:
+            return json.loads(self.transport.post(endpoint, params))
+        return json.loads(self.transport.get(endpoint, params))
+
+
+    def _call_solr_update_api(self, core, command):
+        """
+        Send a JSON update command, e.g. {'delete': {'query': 'app_id:"com.example"'}}
+        """
+        self._count_request()
+        return json.loads(self.transport.post_json(core + '/update', command, {'wt': 'json'}))
 
 
     def _call_solr_core_api(self, params):
-        # print self.solr_url + '/solr/admin/cores?' + urllib.urlencode(params)
-        return urllib2.urlopen(self.solr_url + '/solr/admin/cores?' + urllib.urlencode(params))
+        self._count_request()
+        return self.transport.get('admin/cores', params)
+
+
+class SolrError(Exception):
+
+    def __init__(self, message, status=0):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class SolrTransport(object):
+    """
+    HTTP client for Solr keeping a pool of persistent connections. Responses are requested gzip compressed,
+    queries exceeding the max. length of an URL are sent by POST. The latencies are recorded per endpoint.
+    """
+
+    # Upper bounds (milliseconds) of the buckets of the latency histograms
+    LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self, solr_url='http://localhost:8983', connect_timeout=5, read_timeout=60, max_connections=10,
+                 max_url_length=2048):
+        """
+        solr_url -- URL to Solr
+        connect_timeout -- Max. number of seconds to establish a connection
+        read_timeout -- Max. number of seconds to wait for data of a response
+        max_connections -- Max. number of idle connections kept open
+        max_url_length -- Queries with longer URLs are sent by POST
+        """
+        url = urlparse.urlparse(solr_url.rstrip('/'))
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_url_length = max_url_length
+        self.connections = Queue.LifoQueue(max_connections)
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, params):
+        """
+        Parameters with a list as value are sent multiple times, e.g. {'group.query': ['a', 'b']}
+        """
+        query = urllib.urlencode(params, True)
+        if len(self.path + '/solr/' + endpoint + '?' + query) > self.max_url_length:
+            return self.request('POST', endpoint, query, {'Content-Type': 'application/x-www-form-urlencoded'})
+        return self.request('GET', endpoint + '?' + query)
+
+    def post(self, endpoint, params):
+        return self.request('POST', endpoint, urllib.urlencode(params, True),
+                            {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def post_json(self, endpoint, data, params={}):
+        path = endpoint + '?' + urllib.urlencode(params) if params else endpoint
+        return self.request('POST', path, json.dumps(data), {'Content-Type': 'application/json'})
+
+    def request(self, method, path, body=None, headers={}):
+        """
+        Send a request to Solr and return the body of the response, raises SolrError if it fails
+        path -- Path relative to /solr/, e.g. 'en/select?q=...'
+        """
+        headers = dict(headers)
+        headers['Accept-Encoding'] = 'gzip'
+        start = time.time()
+        retry = True
+        while True:
+            connection, reused = None, False
+            try:
+                connection, reused = self._acquire()
+                connection.request(method, self.path + '/solr/' + path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                if connection:
+                    connection.close()
+                # Solr may have closed a kept-alive connection in the meantime, retry once with a new connection
+                if reused and retry and not isinstance(e, socket.timeout):
+                    retry = False
+                    continue
+                raise SolrError('Request to Solr failed: %s' % str(e))
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        self._record(path.split('?')[0], time.time() - start)
+        if response.getheader('content-encoding') == 'gzip':
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        if response.status != 200:
+            raise SolrError('HTTP %d: %s' % (response.status, content[:200]), response.status)
+        return content
+
+    def get_stats(self):
+        """
+        Return the number of requests, mean and max. latency and the latency histogram per endpoint
+        """
+        labels = ['<=%dms' % bound for bound in self.LATENCY_BUCKETS] + ['>%dms' % self.LATENCY_BUCKETS[-1]]
+        stats = {}
+        with self.lock:
+            for endpoint, latency in self.latencies.iteritems():
+                stats[endpoint] = {
+                    'requests': latency['requests'],
+                    'mean_ms': latency['total_ms'] / latency['requests'],
+                    'max_ms': latency['max_ms'],
+                    'histogram': dict(zip(labels, latency['histogram'])),
+                }
+        return stats
+
+    def _acquire(self):
+        """
+        Return a tuple (connection, reused), an idle connection of the pool or a new one
+        """
+        try:
+            return self.connections.get_nowait(), True
+        except Queue.Empty:
+            if self.scheme == 'https':
+                connection = httplib.HTTPSConnection(self.netloc, timeout=self.connect_timeout)
+            else:
+                connection = httplib.HTTPConnection(self.netloc, timeout=self.connect_timeout)
+            connection.connect()
+            connection.sock.settimeout(self.read_timeout)
+            return connection, False
+
+    def _release(self, connection):
+        try:
+            self.connections.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def _record(self, endpoint, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = {
+                    'requests': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(self.LATENCY_BUCKETS) + 1),
+                }
+            latency = self.latencies[endpoint]
+            latency['requests'] += 1
+            latency['total_ms'] += ms
+            latency['max_ms'] = max(latency['max_ms'], ms)
+            latency['histogram'][bisect.bisect_left(self.LATENCY_BUCKETS, ms)] += 1
+
+
+class SolrIndexer(object):
+    """
+    Sends documents in batches to the update handler of Solr cores. Batches are sent by several threads, each one
+    using a persistent HTTP connection. Documents become visible within commit_within milliseconds, all cores
+    are committed once by finish().
+
+    Usage:
+    indexer = SolrIndexer('http://localhost:8983')
+    indexer.add('en', {'id': 'com.example_title', 'value': 'Example'})
+    stats = indexer.finish()
+    """
+
+    def __init__(self, solr_url='http://localhost:8983', batch_size=1000, threads=4, commit_within=10000,
+                 retries=3, backoff=1.0, timeout=60):
+        """
+        solr_url -- URL to Solr
+        batch_size -- Number of documents sent per request
+        threads -- Number of threads sending batches in parallel
+        commit_within -- Max. number of milliseconds until sent documents are committed by Solr
+        retries -- Number of times a failed request is retried
+        backoff -- Seconds to wait before the first retry, doubled for each further retry
+        timeout -- Timeout of a request in seconds
+        """
+        url = urlparse.urlparse(solr_url.rstrip('/') if solr_url else 'http://localhost:8983')
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path
+        self.batch_size = batch_size
+        self.commit_within = commit_within
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.batches = {}
+        self.cores = set()
+        self.queue = Queue.Queue(threads * 2)
+        self.lock = threading.Lock()
+        self.n_docs = 0
+        self.n_requests = 0
+        self.n_retries = 0
+        self.errors = []
+        self.start = time.time()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._send_batches)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, core, doc):
+        """
+        Queue a document for the given core, blocks if the sender threads cannot keep up
+        doc -- Dictionary field => value, multi-valued fields are given as list
+        """
+        self.cores.add(core)
+        batch = self.batches.setdefault(core, [])
+        batch.append(doc)
+        if len(batch) >= self.batch_size:
+            self.queue.put((core, batch))
+            self.batches[core] = []
+
+    def add_xml(self, core, xml_file):
+        """
+        Queue the documents of a Solr XML file, returns the number of documents
+        """
+        n_docs = 0
+        for _, elem in ElementTree.iterparse(xml_file):
+            if elem.tag != 'doc':
+                continue
+            doc = {}
+            for field in elem:
+                name = field.attrib['name']
+                value = field.text or ''
+                if name in doc:
+                    doc[name] = (doc[name] if isinstance(doc[name], list) else [doc[name]]) + [value]
+                else:
+                    doc[name] = value
+            elem.clear()
+            self.add(core, doc)
+            n_docs += 1
+        return n_docs
+
+    def finish(self):
+        """
+        Send the remaining documents, wait for the sender threads and commit all cores.
+        Returns statistics, raises an exception if documents could not be sent.
+        """
+        for core, batch in self.batches.iteritems():
+            if batch:
+                self.queue.put((core, batch))
+        self.batches = {}
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        connection = self._connect()
+        for core in sorted(self.cores):
+            self._post(connection, core, {'commit': {}}, {'wt': 'json'})
+        connection.close()
+        seconds = time.time() - self.start
+        stats = {
+            'docs': self.n_docs,
+            'requests': self.n_requests,
+            'retries': self.n_retries,
+            'seconds': seconds,
+            'docs_per_second': self.n_docs / seconds if seconds else 0.0,
+        }
+        if self.errors:
+            raise Exception('%d batches could not be indexed: %s' % (len(self.errors), self.errors[0]))
+        return stats
+
+    def _send_batches(self):
+        connection = self._connect()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            core, batch = item
+            try:
+                self._post(connection, core, batch, {'commitWithin': self.commit_within, 'wt': 'json'})
+                with self.lock:
+                    self.n_docs += len(batch)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append("Core '%s': %s" % (core, str(e)))
+        connection.close()
+
+    def _post(self, connection, core, data, params):
+        """
+        POST the data as JSON to the update handler of the core, retrying on connection errors and server errors
+        """
+        body = json.dumps(data)
+        url = self.path + '/solr/' + core + '/update?' + urllib.urlencode(params)
+        attempt = 0
+        while True:
+            try:
+                with self.lock:
+                    self.n_requests += 1
+                connection.request('POST', url, body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                # Read the whole response, otherwise the connection cannot be reused
+                content = response.read()
+                if response.status == 200:
+                    return
+                error = 'HTTP %d: %s' % (response.status, content[:200])
+                # Client errors, e.g. invalid documents, fail again when retried
+                if response.status < 500:
+                    raise Exception(error)
+            except (httplib.HTTPException, socket.error) as e:
+                error = str(e)
+                connection.close()
+            if attempt >= self.retries:
+                raise Exception(error)
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+            with self.lock:
+                self.n_retries += 1
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(solr_url, connect_timeout=5, read_timeout=60):
+    """
+    Return the process-wide transport of the given Solr, the timeouts are used when the transport is created
+    """
+    solr_url = solr_url.rstrip('/')
+    with _transports_lock:
+        if solr_url not in _transports:
+            _transports[solr_url] = SolrTransport(solr_url, connect_timeout, read_timeout)
+        return _transports[solr_url]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_solr(solr_url='http://localhost:8983'):
+    """
+    Return the process-wide client of the given Solr. Creating it does not send any request, the list of cores is
+    fetched on first use and cached.
+    """
+    solr_url = solr_url.rstrip('/') if solr_url else 'http://localhost:8983'
+    with _clients_lock:
+        if solr_url not in _clients:
+            _clients[solr_url] = Solr('', solr_url)
+        return _clients[solr_url]
+
+
+def get_stats():
+    """
+    Return the latency statistics of all transports
+    """
+    with _transports_lock:
+        return dict([(url, transport.get_stats()) for url, transport in _transports.iteritems()])
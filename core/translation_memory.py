@@ -0,0 +1,88 @@
+import collections
+import threading
+import hashlib
+import json
+from translator import Translator
+import utils
+
+
+class TranslationMemory(Translator):
+    """
+    Wraps a translator and serves strings that were translated before (by the same translator with the same
+    settings) from a store. Only strings missing in the store are sent to the wrapped translator.
+    """
+
+    # Settings not affecting the translations, changing them keeps the stored translations valid
+    DEBUG_SETTINGS = ['debug', 'debug_files']
+
+    def __init__(self, translator, store):
+        """
+        translator -- Instance of Translator providing get_id() and its settings in the attribute 'config'
+        store -- Instance of cache.LRUCache, use a cache backed by a SQLite database to persist translations
+        """
+        self.translator = translator
+        self.store = store
+        settings = dict([(k, v) for k, v in translator.config.iteritems() if k not in self.DEBUG_SETTINGS])
+        self.settings_hash = hashlib.md5(json.dumps(settings, sort_keys=True)).hexdigest()
+
+    def get_id(self):
+        return self.translator.get_id()
+
+    def get_all(self, strings, lang_from, lang_to):
+        return self.translator.get_all(strings, lang_from, lang_to)
+
+    def get(self, strings, lang_from, lang_to):
+        keys = [self._get_key(string, lang_from, lang_to) for string in strings]
+        translations = {}
+        misses = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if key in translations or key in misses:
+                continue
+            translation = self.store.get(key)
+            if translation is None:
+                misses[key] = strings[i]
+            else:
+                translations[key] = translation
+        _count(lang_from, lang_to, len(translations), len(misses))
+        debug = 'Translation memory: %d hits, %d misses' % (len(translations), len(misses))
+        if len(misses):
+            result = self.translator.get(misses.values(), lang_from, lang_to)
+            for i, key in enumerate(misses.keys()):
+                translation = result['translations'][i]
+                translations[key] = translation
+                # Do not store the missing results of failed requests
+                if translation is not None:
+                    self.store.set(key, translation)
+            debug += '\n' + result['debug'] if result['debug'] else ''
+        return {
+            'translations': [translations[key] for key in keys],
+            'debug': debug
+        }
+
+    def _get_key(self, string, lang_from, lang_to):
+        normalized = ' '.join(utils.to_utf8(string).split())
+        key = '\t'.join([self.translator.get_id(), self.settings_hash, lang_from, lang_to, normalized])
+        return hashlib.md5(key).hexdigest()
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(lang_from, lang_to, hits, misses):
+    with _stats_lock:
+        stats = _stats.setdefault(lang_from + '-' + lang_to, {'hits': 0, 'misses': 0})
+        stats['hits'] += hits
+        stats['misses'] += misses
+
+
+def get_stats():
+    """
+    Return the hits, misses and hit rate of all translation memories per language pair
+    """
+    with _stats_lock:
+        stats = {}
+        for langs, counts in _stats.iteritems():
+            total = counts['hits'] + counts['misses']
+            stats[langs] = dict(counts, hit_rate=counts['hits'] / float(total) if total else 0.0)
+        return stats
@@ -1,8 +1,10 @@
 import os
 import getopt
 import sys
+import multiprocessing
 import extractor
-from solr import Solr
+from manifest import Manifest
+from solr import Solr, SolrIndexer
 import cgi
 
 """
@@ -14,9 +16,15 @@ $ python translations2solr.py --input_dir=/path/to/extracted/APKs --solr_dir=/pa
 Arguments:
 --input_dir			Path to a folder containing extracted APK files
 --output_dir        Path to a directory where the Solr XML files are written
---mode              (EI|E|I) where 'E' does extract/preprocess translations as Solr XML; 'I' does index them into Solr (default='EI', meaning extract AND index)
---solr_dir  		Path to Solr directory. Note: Mandatory for mode 'I'
+--mode              (EI|E|I|S) where 'E' does extract/preprocess translations as Solr XML; 'I' does index them into Solr (default='EI', meaning extract AND index)
+                    'S' streams the extracted translations to Solr without writing Solr XML files
+--solr_dir  		Path to Solr directory
 --solr_url  		URL to access Solr (default='http://localhost:8983') Note: Mandatory for mode 'I'
+--batch_size        Number of documents sent to Solr per request (default=1000)
+--index_threads     Number of threads sending documents to Solr in parallel (default=4)
+--workers           Number of processes extracting the APKs in parallel (default=number of CPUs)
+--full              Extract and index all APKs. By default, only APKs that are new or changed since the last run are
+                    processed and the documents of removed APKs are deleted from Solr (see manifest.py)
 
 @author Stefan Wanzenried <stefan.wanzenried@gmail.com>
 """
@@ -25,12 +33,17 @@ class Translations2Solr:
     # Contains extracted translations and preprocessed solr xml files
     TMP_DIR_SOLR_XML = 'solr_xml'
     SUBDIR_APPS = 'apps'
+    MANIFEST = 'manifest.json'
 
-    def __init__(self, dir_apks_in, dir_xml_out, solr):
+    def __init__(self, dir_apks_in, dir_xml_out, solr, workers=1, incremental=True, batch_size=1000, index_threads=4):
         """
         dir_apks_in -- Absolute path of directory containing extracted APK files, one folder per app
         dir_xml_out -- Absolute path to directory where the Solr XML files are written
         solr        -- Instance of class Solr
+        workers     -- Number of processes extracting the APKs in parallel
+        incremental -- If true, only process APKs that changed since the last run, otherwise process all APKs
+        batch_size  -- Number of documents sent to Solr per request
+        index_threads -- Number of threads sending documents to Solr in parallel
         """
         self.dir_apks_in = dir_apks_in.rstrip('/') + '/'
         self.dir_xml_out = dir_xml_out.rstrip('/') + '/'
@@ -39,41 +52,197 @@ class Translations2Solr:
         if not os.path.isdir(os.path.join(self.dir_xml_out, self.SUBDIR_APPS)):
             os.makedirs(os.path.join(self.dir_xml_out, self.SUBDIR_APPS))
         self.solr = solr
+        self.workers = workers
+        self.batch_size = batch_size
+        self.index_threads = index_threads
+        # Records the extracted APKs and their state in Solr
+        self.manifest = Manifest(os.path.join(self.dir_xml_out, self.MANIFEST))
+        if not incremental:
+            self.manifest.clear()
 
 
     def write_xml(self):
         """
-        Create solr xml files of extracted translations
+        Create solr xml files of extracted translations, only for new or changed APKs
         """
-        for f in os.listdir(self.dir_apks_in):
-            if f[0] == '.':
+        changed, removed = self.manifest.get_changes(self.dir_apks_in)
+        # APKs indexed by stream() have no Solr XML files yet
+        changed += [folder for folder, entry in sorted(self.manifest.entries.items())
+                    if entry.get('xml') is False and not entry.get('removed') and folder not in changed]
+        print "%d new or changed APKs, %d removed APKs" % (len(changed), len(removed))
+        for folder in removed:
+            entry = self.manifest.get(folder)
+            if entry.get('removed'):
                 continue
-            apk_folder = os.path.realpath(os.path.join(self.dir_apks_in, f))
-            ext = extractor.Extractor(apk_folder)
-            app_id = ext.extract_app_id()
+            self._delete_xml(entry['app_id'], entry['languages'])
+            # Documents are deleted from Solr by index(), an APK appearing again is extracted as changed one
+            entry['removed'] = True
+            entry['hash'] = ''
+        # APKs are parsed by the worker processes, the files are written by this process only
+        for folder, app_id, translations in extractor.extract_apks(self.dir_apks_in, self.workers, changed):
             print "\nPrepare solr xml for app: " + app_id + "\n"
-            translations = ext.extract_translations()
+            entry = self.manifest.get(folder)
+            if entry:
+                self._delete_xml(entry['app_id'], entry['languages'])
             self._write_app_xml(app_id, translations)
             for language in translations:
                 self._write_translations_xml(app_id, language, translations[language])
+            self.manifest.update(os.path.join(self.dir_apks_in, folder), app_id=app_id, languages=translations.keys(),
+                                 removed=False, xml=True)
+        self.manifest.save()
+
+
+    def stream(self):
+        """
+        Extract the translations of APKs not indexed in their current state and send them to Solr directly, without
+        writing Solr XML files. The documents of changed and removed APKs are deleted beforehand.
+        """
+        changed, removed = self.manifest.get_changes(self.dir_apks_in)
+        # APKs extracted by write_xml but not indexed since are up to date on disk only
+        changed += [folder for folder, entry in sorted(self.manifest.entries.items())
+                    if not entry.get('removed') and entry.get('indexed') != entry['hash']
+                    and folder not in changed + removed]
+        print "%d new or changed APKs, %d removed APKs" % (len(changed), len(removed))
+        deletes = {}
+        for folder in changed + removed:
+            entry = self.manifest.get(folder)
+            if not entry:
+                continue
+            if entry.get('indexed'):
+                for core in [self.SUBDIR_APPS] + entry['indexed_languages']:
+                    deletes.setdefault(core, []).append(entry['indexed_app_id'])
+            # Solr XML files of previous runs are outdated
+            self._delete_xml(entry['app_id'], entry['languages'])
+        for folder in removed:
+            self.manifest.remove(folder)
+        for core, app_ids in deletes.iteritems():
+            self.solr.delete_apps(core, app_ids)
+        # The indexer blocks once its queue of batches is full, so extraction cannot run ahead of Solr
+        indexer = SolrIndexer(self.solr.solr_url, self.batch_size, self.index_threads)
+        for folder, app_id, translations in extractor.extract_apks(self.dir_apks_in, self.workers, changed):
+            print "Index app: " + app_id
+            self.solr.create_core(self.SUBDIR_APPS, Solr.CONFIGSET_APPS)
+            indexer.add(self.SUBDIR_APPS, self._get_app_document(app_id, translations))
+            for language in translations:
+                if not translations[language]:
+                    continue
+                self.solr.create_core(language, Solr.CONFIGSET_TRANSLATIONS)
+                for doc in self._get_translation_documents(app_id, translations[language]):
+                    indexer.add(language, doc)
+            entry = self.manifest.update(os.path.join(self.dir_apks_in, folder), app_id=app_id,
+                                         languages=translations.keys(), removed=False, xml=False)
+            entry['indexed'] = entry['hash']
+            entry['indexed_app_id'] = app_id
+            entry['indexed_languages'] = entry['languages']
+        stats = indexer.finish()
+        self.manifest.save()
+        print "Deleted the documents of %d apps" % len(deletes.get(self.SUBDIR_APPS, []))
+        print "Indexed %d documents in %.1f seconds (%.1f docs/sec, %d retries)" % (
+            stats['docs'], stats['seconds'], stats['docs_per_second'], stats['retries'])
 
 
     def index(self):
         """
-        Index solr xml files into Solr
+        Index solr xml files into Solr. The documents of APKs changed since they were indexed are replaced, the
+        documents of removed APKs are deleted.
         """
-        dir_apps = os.path.join(self.dir_xml_out, self.SUBDIR_APPS)
-        for app in os.listdir(dir_apps):
-            if app == '.':
+        if not self.manifest.entries:
+            # Solr XML files not written by write_xml, e.g. by a previous version: Index all of them
+            self._index_all()
+            return
+        deletes = {}
+        documents = {}
+        for folder, entry in sorted(self.manifest.entries.items()):
+            if entry.get('removed') or entry.get('indexed') != entry['hash']:
+                # Delete all documents of the app, otherwise strings removed from the APK remain in the index
+                if entry.get('indexed'):
+                    for core in [self.SUBDIR_APPS] + entry['indexed_languages']:
+                        deletes.setdefault(core, []).append(entry['indexed_app_id'])
+            if entry.get('removed'):
+                self.manifest.remove(folder)
                 continue
-            xml = os.path.join(dir_apps, app)
-            self.solr.index(xml, 'apps', Solr.CONFIGSET_APPS)
+            if entry.get('indexed') == entry['hash']:
+                continue
+            for core in [self.SUBDIR_APPS] + entry['languages']:
+                xml = os.path.join(self.dir_xml_out, core, entry['app_id'] + '.xml')
+                if os.path.isfile(xml):
+                    documents.setdefault(core, []).append(xml)
+            entry['indexed'] = entry['hash']
+            entry['indexed_app_id'] = entry['app_id']
+            entry['indexed_languages'] = entry['languages']
+        for core, app_ids in deletes.iteritems():
+            self.solr.delete_apps(core, app_ids)
+        self._index_files(documents)
+        self.manifest.save()
+        print "Deleted the documents of %d apps" % len(deletes.get(self.SUBDIR_APPS, []))
+
 
+    def _index_all(self):
+        documents = {self.SUBDIR_APPS: [os.path.join(self.dir_xml_out, self.SUBDIR_APPS)]}
         for language in os.listdir(self.dir_xml_out):
-            if language == '.':
-                continue
             xml = os.path.join(self.dir_xml_out, language)
-            self.solr.index(xml, language)
+            if language[0] == '.' or language == self.SUBDIR_APPS or not os.path.isdir(xml):
+                continue
+            documents[language] = [xml]
+        self._index_files(documents)
+
+
+    def _index_files(self, documents):
+        """
+        Send the documents of all cores with a single indexer, all cores are committed once at the end
+        documents -- Dictionary core => list of xml files or directories
+        """
+        indexer = SolrIndexer(self.solr.solr_url, self.batch_size, self.index_threads)
+        n_files = 0
+        for core, xml_files in sorted(documents.items()):
+            configset = Solr.CONFIGSET_APPS if core == self.SUBDIR_APPS else ''
+            self.solr.index(xml_files, core, configset, indexer)
+            n_files += len(xml_files)
+        stats = indexer.finish()
+        print "Indexed %d documents of %d files in %.1f seconds (%.1f docs/sec, %d retries)" % (
+            stats['docs'], n_files, stats['seconds'], stats['docs_per_second'], stats['retries'])
+
+
+    def _delete_xml(self, app_id, languages):
+        """
+        Delete the Solr XML files written for an app
+        """
+        for folder in [self.SUBDIR_APPS] + languages:
+            xml = os.path.join(self.dir_xml_out, folder, app_id + '.xml')
+            if os.path.isfile(xml):
+                os.remove(xml)
+
+
+    @staticmethod
+    def _get_app_document(app_id, translations):
+        """
+        Return the document of the 'apps' core, same fields as written by _write_app_xml
+        """
+        doc = {
+            'id': app_id,
+            'app_id': app_id,
+            'languages': list(translations.keys()),
+        }
+        for lang in translations:
+            doc['count_' + lang] = len(translations[lang])
+        return doc
+
+
+    @staticmethod
+    def _get_translation_documents(app_id, translations):
+        """
+        Yield the documents of a language core, same fields as written by SolrXMLWriter
+        """
+        for key, value in translations.iteritems():
+            if not value:
+                continue
+            yield {
+                'id': Solr.get_document_id(app_id, key),
+                'app_id': app_id,
+                'key': key,
+                'value': value,
+                'value_lc': '%s %s %s' % (Solr.DELIMITER_START, value, Solr.DELIMITER_END),
+            }
 
 
     def _write_app_xml(self, app_id, translations):
@@ -120,7 +289,7 @@ class SolrXMLWriter(object):
                     continue
                 value = cgi.escape(value)
                 f.write('<doc>\n')
-                f.write('<field name="id">' + '_'.join([app_id, key]) + '</field>\n')
+                f.write('<field name="id">' + Solr.get_document_id(app_id, key) + '</field>\n')
                 f.write('<field name="app_id">%s</field>\n' % app_id)
                 f.write('<field name="key">%s</field>\n' % key)
                 f.write('<field name="value">%s</field>\n' % value)
@@ -130,7 +299,7 @@ class SolrXMLWriter(object):
 
 if __name__ == "__main__":
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'i:m:d:u:o:', ['input_dir=', 'mode=', 'solr_dir=', 'solr_url=', 'output_dir='])
+        opts, args = getopt.getopt(sys.argv[1:], 'i:m:d:u:o:w:fb:t:', ['input_dir=', 'mode=', 'solr_dir=', 'solr_url=', 'output_dir=', 'workers=', 'full', 'batch_size=', 'index_threads='])
     except getopt.GetoptError as err:
         print str(err)
         sys.exit(2)
@@ -140,6 +309,10 @@ if __name__ == "__main__":
     solr_dir = ''
     solr_url = ''
     output_dir = ''
+    workers = multiprocessing.cpu_count()
+    incremental = True
+    batch_size = 1000
+    index_threads = 4
     for opt, arg in opts:
         if opt in ('-i', '--input_dir'):
             input_dir = arg
@@ -151,25 +324,36 @@ if __name__ == "__main__":
             solr_url = arg
         if opt in ('-o', '--output_dir'):
             output_dir = arg
+        if opt in ('-w', '--workers'):
+            workers = int(arg)
+        if opt in ('-f', '--full'):
+            incremental = False
+        if opt in ('-b', '--batch_size'):
+            batch_size = int(arg)
+        if opt in ('-t', '--index_threads'):
+            index_threads = int(arg)
 
     # mode = extract
-    if 'e' in mode.lower():
+    if 'e' in mode.lower() or 's' in mode.lower():
         if not os.path.isdir(input_dir):
             print input_dir + " must be a folder containing extracted APK files"
             sys.exit(2)
 
     # mode = index
     solr = None
-    if 'i' in mode.lower():
-        if not os.path.isdir(solr_dir):
+    if 'i' in mode.lower() or 's' in mode.lower():
+        # Documents are sent over HTTP, the Solr directory is optional
+        if solr_dir and not os.path.isdir(solr_dir):
             print "The path to Solr '" + solr_dir + "' is not valid"
             sys.exit(2)
-        else:
-            solr = Solr(solr_dir, solr_url)
+        solr = Solr(solr_dir, solr_url)
 
     # Run it!
-    app = Translations2Solr(input_dir, output_dir, solr)
-    if 'e' in mode.lower():
-        app.write_xml()
-    if 'i' in mode.lower():
-        app.index()
+    app = Translations2Solr(input_dir, output_dir, solr, workers, incremental, batch_size, index_threads)
+    if 's' in mode.lower():
+        app.stream()
+    else:
+        if 'e' in mode.lower():
+            app.write_xml()
+        if 'i' in mode.lower():
+            app.index()
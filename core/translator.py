@@ -1,8 +1,18 @@
 import subprocess
+import collections
 import hashlib
+import json
+import tempfile
+import shlex
 import os
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from extractor import ExtractTranslationsFromXML
-from solr import Solr
+from solr import Solr, get_solr
+import decoder_pool
+import cache
+import phrase_index
 import utils
 import operator
 
@@ -26,6 +36,23 @@ class Translator(object):
             'translations' : ["Result1", "Result2" ...],
             'debug' : "Debug information"
         }
+
+        Duplicate strings are translated only once, see _get()
+        """
+        unique = collections.OrderedDict()
+        for string in strings:
+            unique.setdefault(string, len(unique))
+        result = self._get(unique.keys(), lang_from, lang_to)
+        result['translations'] = [result['translations'][unique[string]] for string in strings]
+        info = 'Deduplication: %d strings, %d unique (%d%% duplicates)' % (
+            len(strings), len(unique), 100 * (len(strings) - len(unique)) // len(strings) if strings else 0)
+        result['debug'] = info + '\n' + result['debug'] if result['debug'] else info
+        return result
+
+    def _get(self, strings, lang_from, lang_to):
+        """
+        Same as get(), called with the distinct strings only. The translations are fanned out by get() to all
+        occurrences of a string, further keys of the returned dictionary are passed through.
         """
         raise NotImplementedError
 
@@ -45,9 +72,69 @@ class Translator(object):
         """
         Translate the given android xml file (containing translations) from the source to the target language
         xml -- Path to android xml file containing strings to translate
+
+        Returns a dictionary
+        {
+            'translations' : [{'key': 'key', 'source': 'Source', 'target': 'Result'}, ...],
+            'debug' : "Debug information"
+        }
+        """
+        e = ExtractTranslationsFromXML(xml)
+        strings = e.extract()
+        result = self.get(strings.values(), lang_from, lang_to)
+        out = []
+        i = 0
+        for key, value in strings.iteritems():
+            out.append(self._get_xml_row(key, value, result['translations'][i]))
+            i += 1
+        # Further keys returned by get() are passed through
+        result['translations'] = out
+        return result
+
+    def translate_xml_stream(self, xml, lang_from, lang_to, chunk_size=50):
+        """
+        Same as translate_xml, but the xml file is parsed incrementally and translated in chunks of strings.
+        Yields the rows {'key': 'key', 'source': 'Source', 'target': 'Result'} as soon as their chunk is translated.
+        """
+        e = ExtractTranslationsFromXML(xml)
+        for chunk in utils.chunks(e.iterextract(), chunk_size):
+            result = self.get([value for _, value in chunk], lang_from, lang_to)
+            for i, (key, value) in enumerate(chunk):
+                yield self._get_xml_row(key, value, result['translations'][i])
+
+    @staticmethod
+    def _get_xml_row(key, source, translation):
+        return {
+            'key': key,
+            'source': source,
+            'target': translation
+        }
+
+    def _get_command(self, lang_from, lang_to, file_input='', file_output='', file_debug=''):
+        """
+        Return the shell command running the decoder, optionally reading from/writing to the given files
         """
         raise NotImplementedError
 
+    def _translate_with_files(self, strings, lang_from, lang_to, dir_temp):
+        """
+        Debug mode: Run the decoder once with input, output and stderr redirected to files in the given directory.
+        The files are not deleted, so that they can be inspected. Returns a tuple (translations, debug)
+        """
+        if not os.path.isdir(dir_temp):
+            os.makedirs(dir_temp)
+        # Unique filenames, concurrent requests translating the same strings must not overwrite each other's files
+        prefix = self._get_temp_filename(''.join(strings), lang_from, lang_to) + '-'
+        fd, file_in = tempfile.mkstemp('.in', prefix, dir_temp)
+        os.close(fd)
+        file_out = file_in[:-len('.in')] + '.out'
+        file_debug = file_in[:-len('.in')] + '.debug'
+        self._write_translations_to_file(strings, file_in)
+        subprocess.check_output(self._get_command(lang_from, lang_to, file_in, file_out, file_debug), shell=True)
+        translations = self._read_translations_from_file(file_out)
+        debug = open(file_debug).read() if os.path.isfile(file_debug) else ''
+        return translations, debug
+
     @staticmethod
     def _get_temp_filename(string, lang_from, lang_to):
         return hashlib.md5(''.join([utils.to_ascii(string), lang_from, lang_to])).hexdigest()
@@ -64,7 +151,7 @@ class Translator(object):
         f = open(filename)
         translations = [value.rstrip() for value in f.read().split('\n')]
         translations.pop()
-        os.remove(filename)
+        f.close()
         return translations
 
 
@@ -79,75 +166,50 @@ class TranslatorMoses(Translator):
         'weight_d': 0.3,
         'weight_l': 0.5,
         'weight_t': 0.2,
-        'weight_w': -1
+        'weight_w': -1,
+        'debug_files': 0,  # Debug mode: Run Moses once per request, with input/output/stderr written to temp files
     }
 
-    def __init__(self, dir_moses, config={}):
+    def __init__(self, dir_moses, config={}, pool_size=1, timeout=300, memory_budget=0):
+        """
+        dir_moses -- Absolute path to Moses
+        config -- Decoder settings passed to Moses
+        pool_size -- Number of Moses processes kept alive per language pair and settings
+        timeout -- Max. number of seconds a request may take
+        memory_budget -- Max. memory in MB used by all resident decoders, least recently used models are unloaded
+        """
         self.config = self.DEFAULT_CONFIG.copy()
         self.config.update(config)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.memory_budget = memory_budget
         self.dir_moses = dir_moses.rstrip('/') + '/'
         dir_data = os.path.dirname(os.path.realpath(__file__)) + '/../data/'
         self.dir_models = dir_data + 'moses/'
         self.dir_temp = dir_data + 'temp/moses/'
-        if not os.path.isdir(self.dir_temp):
-            os.makedirs(self.dir_temp)
 
     def get_id(self):
         return 'moses'
 
-    def translate_xml(self, xml, lang_from, lang_to):
-        e = ExtractTranslationsFromXML(xml)
-        translations = e.extract()
-        # Write a file with one translation per line that can be processed by Moses
-        filename_in = os.path.join(self.dir_temp, self._get_temp_filename(xml + 'in', lang_from, lang_to))
-        self._write_translations_to_file(translations.values(), filename_in)
-        filename_debug = os.path.join(self.dir_temp, self._get_temp_filename(xml + 'debug', lang_from, lang_to))
-        cmd = self._get_command(lang_from, lang_to, filename_in, '', filename_debug)
-        result = subprocess.check_output(cmd, shell=True)
-        dbg = self._get_debug_from_file(filename_debug)
-        os.remove(filename_in)
-        out = []
-        i = 0
-        trans = result.split('\n')
-        for key, value in translations.iteritems():
-            row = {
-                'key': key,
-                'source': value,
-                'target': trans[i].strip()
-            }
-            out.append(row)
-            i += 1
-        return {
-            'translations': out,
-            'debug': dbg
-        }
-
     def get_all(self, strings, lang_from, lang_to):
         pass
 
-    def get(self, strings, lang_from, lang_to):
-        hash = ''.join(strings)
-        file_in = os.path.join(self.dir_temp, self._get_temp_filename(hash, lang_from, lang_to))
-        file_out = os.path.join(self._get_temp_filename(hash + 'out', lang_from, lang_to))
-        self._write_translations_to_file(strings, file_in)
-        file_debug = os.path.join(self.dir_temp, self._get_temp_filename(hash + 'debug', lang_from, lang_to))
-        cmd = self._get_command(lang_from, lang_to, file_in, file_out, file_debug)
-        subprocess.check_output(cmd, shell=True)
-        translations = self._read_translations_from_file(file_out)
-        dbg = self._get_debug_from_file(file_debug)
-        os.remove(file_in)
+    def _get(self, strings, lang_from, lang_to):
+        if self.config['debug_files']:
+            translations, dbg = self._translate_with_files(strings, lang_from, lang_to, self.dir_temp)
+        else:
+            translations, dbg = self._get_pool(lang_from, lang_to).translate(strings)
         return {
             'translations': translations,
             'debug': dbg
         }
 
-    @staticmethod
-    def _get_debug_from_file(file_debug):
-        dbg = ''
-        if os.path.isfile(file_debug):
-            dbg = open(file_debug, 'r').read()
-            os.remove(file_debug)
-        return dbg
+    def _get_pool(self, lang_from, lang_to):
+        """
+        Return the pool of warm Moses processes serving the given language pair with the current settings
+        """
+        cmd = self._get_command(lang_from, lang_to)
+        return decoder_pool.get_pool(cmd, self.pool_size, self.timeout, self.memory_budget)
 
     def _get_command(self, lang_from, lang_to, file_input='', file_output='', file_debug=''):
         cmd = self.dir_moses + 'bin/moses -f ' + self.dir_models + lang_from + '-' + lang_to + '/mert-work/moses.ini'
@@ -166,7 +228,7 @@ class TranslatorMoses(Translator):
             'weight_t': 'TranslationModel0'
         }
         for key, value in self.config.iteritems():
-            if key == 'tune_weights':
+            if key in ['tune_weights', 'debug_files']:
                 continue
             if not self.config['tune_weights'] and key.startswith('weight'):
                 continue
@@ -182,6 +244,7 @@ class TranslatorLamtram(Translator):
     DEFAULT_CONFIG = {
         'beam': 5,
         'word_pen': 0,
+        'debug_files': 0,  # Debug mode: Input/output/stderr of Lamtram are written to temp files
     }
 
     def __init__(self, dir_lamtram, config={}):
@@ -191,55 +254,39 @@ class TranslatorLamtram(Translator):
         dir_data = os.path.dirname(os.path.realpath(__file__)) + '/../data/'
         self.dir_models = dir_data + 'lamtram/'
         self.dir_temp = dir_data + 'temp/lamtram/'
-        if not os.path.isdir(self.dir_temp):
-            os.makedirs(self.dir_temp)
 
     def get_id(self):
         return 'lamtram'
 
-    def translate_xml(self, xml, lang_from, lang_to):
-        e = ExtractTranslationsFromXML(xml)
-        translations = e.extract()
-        # Write a file with one translation per line that can be processed by Lamtram
-        filename_input = os.path.join(self.dir_temp, self._get_temp_filename(xml + 'in', lang_from, lang_to))
-        self._write_translations_to_file(translations.values(), filename_input)
-        cmd = self._get_command(lang_from, lang_to, filename_input)
-        result = subprocess.check_output(cmd, shell=True)
-        os.remove(filename_input)
-        out = []
-        i = 0
-        trans = result.split('\n')
-        for key, value in translations.iteritems():
-            row = {
-                'key': key,
-                'source': value,
-                'target': trans[i].strip()
-            }
-            out.append(row)
-            i += 1
-        return {
-            'translations': out,
-            'debug': ''
-        }
-
     def get_all(self, strings, lang_from, lang_to):
         pass
 
-    def get(self, strings, lang_from, lang_to):
-        hash = ''.join(strings)
-        file_in = os.path.join(self.dir_temp, self._get_temp_filename(hash, lang_from, lang_to))
-        file_out = os.path.join(self.dir_temp, self._get_temp_filename(hash + 'out', lang_from, lang_to))
-        self._write_translations_to_file(strings, file_in)
-        cmd = self._get_command(lang_from, lang_to, file_in, file_out)
-        subprocess.check_output(cmd, shell=True)
-        translations = self._read_translations_from_file(file_out)
-        os.remove(file_in)
+    def _get(self, strings, lang_from, lang_to):
+        if self.config['debug_files']:
+            translations, dbg = self._translate_with_files(strings, lang_from, lang_to, self.dir_temp)
+        else:
+            translations, dbg = self._translate_with_pipes(strings, lang_from, lang_to), ''
         return {
             'translations': translations,
-            'debug': ''
+            'debug': dbg
         }
 
-    def _get_command(self, lang_from, lang_to, file_input, file_output='', file_debug=''):
+    def _translate_with_pipes(self, strings, lang_from, lang_to):
+        """
+        Run Lamtram reading the strings from stdin, translations are read from stdout
+        """
+        if not len(strings):
+            return []
+        cmd = self._get_command(lang_from, lang_to, '/dev/stdin')
+        process = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=open(os.devnull, 'w'), close_fds=True)
+        out, _ = process.communicate(''.join([' '.join(utils.to_utf8(string).split()) + '\n' for string in strings]))
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        translations = [value.strip() for value in out.split('\n')][:len(strings)]
+        return translations + [''] * (len(strings) - len(translations))
+
+    def _get_command(self, lang_from, lang_to, file_input='', file_output='', file_debug=''):
         cmd = self.dir_lamtram + 'src/lamtram/lamtram --operation gen --models_in encdec='
         cmd = cmd + self.dir_models + lang_from + '-' + lang_to + '/transmodel.out'
         cmd = cmd + ' --beam ' + str(self.config['beam']) + ' --word_pen ' + str(
@@ -253,78 +300,79 @@ class TranslatorTensorflow(Translator):
     DEFAULT_CONFIG = {
         'num_layers': 3,
         'size': 1024,
+        'beam_size': 1,  # 1 means greedy decoding
+        'length_penalty': 0.6,  # Beam search scores are normalized by length ** length_penalty
+        'debug_files': 0,  # Debug mode: Run tflow.py once per request, with input/output/stderr written to temp files
     }
 
-    def __init__(self, config={}):
+    def __init__(self, config={}, pool_size=1, timeout=300, memory_budget=0):
+        """
+        config -- Decoder settings
+        pool_size -- Number of decoder processes kept alive per model
+        timeout -- Max. number of seconds a request may take
+        memory_budget -- Max. memory in MB used by all resident decoders, least recently used models are unloaded
+        """
         self.config = self.DEFAULT_CONFIG.copy()
         self.config.update(config)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.memory_budget = memory_budget
         dir_data = os.path.dirname(os.path.realpath(__file__)) + '/../data/'
         self.dir_models = dir_data + 'tensorflow/'
         self.dir_temp = dir_data + 'temp/tensorflow/'
-        if not os.path.isdir(self.dir_temp):
-            os.makedirs(self.dir_temp)
 
     def get_id(self):
         return 'tensorflow'
 
-    def translate_xml(self, xml, lang_from, lang_to):
-        e = ExtractTranslationsFromXML(xml)
-        translations = e.extract()
-        # Write a file with one translation per line that can be processed by Lamtram
-        filename_input = os.path.join(self.dir_temp, self._get_temp_filename(xml + 'in', lang_from, lang_to))
-        self._write_translations_to_file(translations.values(), filename_input)
-        cmd = self._get_command(lang_from, lang_to, filename_input)
-        result = subprocess.check_output(cmd, shell=True)
-        os.remove(filename_input)
-        out = []
-        i = 0
-        trans = result.split('\n')
-        for key, value in translations.iteritems():
-            row = {
-                'key': key,
-                'source': value,
-                'target': trans[i].strip()
-            }
-            out.append(row)
-            i += 1
-        return {
-            'translations': out,
-            'debug': ''
-        }
-
     def get_all(self, strings, lang_from, lang_to):
         pass
 
-    def get(self, strings, lang_from, lang_to):
-        hash = ''.join(strings)
-        file_in = os.path.join(self.dir_temp, self._get_temp_filename(hash, lang_from, lang_to))
-        file_out = os.path.join(self.dir_temp, self._get_temp_filename(hash + 'out', lang_from, lang_to))
-        self._write_translations_to_file(strings, file_in)
-        cmd = self._get_command(lang_from, lang_to, file_in, file_out)
-        subprocess.check_output(cmd, shell=True)
-        translations = self._read_translations_from_file(file_out)
-        os.remove(file_in)
+    def _get(self, strings, lang_from, lang_to):
+        if self.config['debug_files']:
+            translations, dbg = self._translate_with_files(strings, lang_from, lang_to, self.dir_temp)
+        else:
+            translations, dbg = self._get_pool(lang_from, lang_to).translate(strings)[0], ''
         return {
             'translations': translations,
-            'debug': ''
+            'debug': dbg
         }
 
-    def _get_command(self, lang_from, lang_to, file_input, file_output='', file_debug=''):
+    def _get_pool(self, lang_from, lang_to):
+        """
+        Return the pool of resident decoders, each one keeps the session and vocabularies of the model loaded
+        """
+        cmd = self._get_command(lang_from, lang_to)
+        return decoder_pool.get_pool(cmd, self.pool_size, self.timeout, self.memory_budget)
+
+    def _get_command(self, lang_from, lang_to, file_input='', file_output='', file_debug=''):
         script = os.path.dirname(os.path.realpath(__file__)) + '/../scripts/tflow.py'
         cmd = 'python ' + script + ' --source ' + lang_from + ' --target ' + lang_to + ' --decode true'
         cmd = cmd + ' --size ' + str(self.config['size']) + ' --num_layers ' + str(self.config['num_layers'])
+        cmd = cmd + ' --beam_size ' + str(self.config['beam_size']) + ' --length_penalty ' + str(self.config['length_penalty'])
         cmd = cmd + ' --data_dir ' + self.dir_models
-        cmd = cmd + ' < ' + file_input
+        cmd = cmd + ' < ' + file_input if file_input else cmd
         cmd = cmd + ' > ' + file_output if file_output else cmd
         cmd = cmd + ' 2> ' + file_debug if file_debug else cmd
         return cmd
 
 
 class SolrBaselineSystem(object):
-    def __init__(self, solr, config):
-        self.cache = {}
+    # Settings changing the translations found for a string, part of the cache key
+    CACHE_SETTINGS = ['rows', 'batch_lookups']
+
+    def __init__(self, solr, config, cache, dir_index=''):
+        """
+        solr -- Instance of Solr
+        config -- Settings of the translator
+        cache -- Instance of cache.LRUCache storing the translations found for strings
+        dir_index -- Directory containing the phrase indexes, used if the setting 'backend' is 'index'
+        """
+        self.cache = cache
         self.config = config
         self.solr = solr
+        self.dir_index = dir_index
+        settings = dict([(key, config.get(key)) for key in self.CACHE_SETTINGS])
+        self.settings_hash = hashlib.md5(json.dumps(settings, sort_keys=True)).hexdigest()
 
     def translate(self, string, source, target):
         debug = '\n\nLooking for direct match translations for string "%s"' % string
@@ -341,9 +389,15 @@ class SolrBaselineSystem(object):
         if len(words) == 1:
             # String was a single word and we didn't get a translation before, we can't do any better
             return string, debug
-        debug += '\nNo direct translations found, starting the substring algorithm...'
-        translated_substrings, info = self._get_translations_substrings(1, words, source, target)
+        n_requests = self.solr.get_thread_requests()
+        if self.config['segmentation'] == 'lattice':
+            debug += '\nNo direct translations found, starting the lattice segmentation...'
+            translated_substrings, info = self._get_translations_lattice(words, source, target)
+        else:
+            debug += '\nNo direct translations found, starting the substring algorithm...'
+            translated_substrings, info = self._get_translations_substrings(1, words, source, target)
         debug += info
+        debug += '\nSolr requests for sub strings: %s' % (self.solr.get_thread_requests() - n_requests)
         translated_substrings = [utils.to_utf8(word) for word in translated_substrings]
         return ' '.join(translated_substrings), debug
 
@@ -411,25 +465,98 @@ class SolrBaselineSystem(object):
                     result.append(word)
         return result, debug
 
+    def _get_translations_lattice(self, words, source, target):
+        """
+        Translate the words by the segmentation into phrases maximizing the total count of the phrase translations.
+        The translations of all phrases (n-grams) are fetched in bulk, afterwards the best segmentation is found with
+        dynamic programming. Words without translation are kept as they are.
+        The result may differ from the heuristic segmentation: The heuristic keeps the longest phrases having a
+        translation and only looks at the most frequent translation of each window, the lattice maximizes the total
+        count over all segmentations, e.g. preferring two frequent short phrases over a rare long one.
+        """
+        length = len(words)
+        max_length = int(self.config['max_phrase_length']) or length
+        spans = [(start, end) for start in range(length) for end in range(start + 1, min(length, start + max_length) + 1)]
+        phrases = self._get_translations_bulk([' '.join(words[start:end]) for start, end in spans], source, target)
+        lattice = {}
+        for span, results in zip(spans, phrases):
+            if len(results):
+                lattice[span] = results[0]
+        debug = '\nTranslated phrases: %s' % str(dict([(' '.join(words[s:e]), t) for (s, e), t in lattice.iteritems()]))
+        # best[i] holds the best segmentation of words[0:i] as tuple (total count, -number of phrases, translations)
+        best = [(0, 0, [])]
+        for end in range(1, length + 1):
+            best.append(None)
+            for start in range(max(0, end - max_length), end):
+                if (start, end) in lattice:
+                    count, translation = lattice[(start, end)]['count'], lattice[(start, end)]['value']
+                elif end - start == 1:
+                    count, translation = 0, words[start]
+                else:
+                    continue
+                candidate = (best[start][0] + count, best[start][1] - 1, best[start][2] + [translation])
+                # On equal counts, prefer fewer (longer) phrases
+                if best[end] is None or candidate[:2] > best[end][:2]:
+                    best[end] = candidate
+        debug += '\nBest segmentation: %s (total count=%s)' % (str(best[length][2]), best[length][0])
+        return best[length][2], debug
+
     def _get_translations(self, string, source, target):
+        if self.config['backend'] == 'index':
+            # Lookup in the local phrase index, this is fast enough to not need any caching
+            index = phrase_index.get_index(phrase_index.get_index_file(self.dir_index, source, target))
+            return index.get_translations(string)
         # Lookup in cache
         results = self._get_cache(string, source, target)
-        if len(results):
+        if results is not None:
             return results
         # Search in Solr for an exact match of the string in the source language
         results = self._find_exact(string, source)
         if not results['numFound']:
+            if not results['error']:
+                self._store_cache(string, source, target, [])
             return []
-        # Collect target translations, sorted by number of total counts
+        values = self.solr.get_aligned_values(target, results['docs'], self.config['batch_lookups'])
+        translations = self._get_candidates(values)
+        self._store_cache(string, source, target, translations)
+        return translations
+
+    def _get_translations_bulk(self, strings, source, target):
+        """
+        Same as _get_translations() for a list of strings, returns a list containing the translations of each string.
+        The strings missing in the cache are looked up with two requests: One query for all exact matches in the
+        source language (using result grouping), one for all aligned documents in the target language.
+        """
+        if self.config['backend'] == 'index':
+            return [self._get_translations(string, source, target) for string in strings]
+        translations = {}
+        queries = {}
+        for string in set(strings):
+            results = self._get_cache(string, source, target)
+            if results is None:
+                queries[self._get_exact_query(string)] = string
+            else:
+                translations[string] = results
+        if queries:
+            groups = self.solr.query_groups(source, queries.keys(), {'group.limit': self.config['rows']})
+            ids = dict([(query, [Solr.get_document_id(doc['app_id'], doc['key']) for doc in groups[query]['docs']])
+                        for query in queries])
+            documents = self.solr.get_documents(target, [id for query in ids for id in ids[query]], 'id,value')
+            for query, string in queries.iteritems():
+                values = [documents[id]['value'] for id in ids[query] if id in documents]
+                translations[string] = self._get_candidates(values)
+                if not groups[query]['error']:
+                    self._store_cache(string, source, target, translations[string])
+        return [translations[string] for string in strings]
+
+    @staticmethod
+    def _get_candidates(values):
+        """
+        Return the distinct (lowercased) values as translations, sorted by their number of occurrences
+        """
         candidates = {}
-        for result in results['docs']:
-            params = {
-                'q': 'app_id:%s AND key:%s' % (result['app_id'], result['key'])
-            }
-            translations = self.solr.query(target, params)
-            if not translations['numFound']:
-                continue
-            value = translations['docs'][0]['value'].lower()
+        for value in values:
+            value = value.lower()
             value = value.strip()
             candidates[value] = 1 if value not in candidates else candidates[value] + 1
         # Sort candidates by best translation candidate (having highest count)
@@ -440,44 +567,59 @@ class SolrBaselineSystem(object):
                 'value': candidate[0],
                 'count': candidate[1]
             })
-        self._store_cache(string, source, target, translations)
         return translations
 
     def _store_cache(self, string, source, target, translations):
-        key = source + target
-        if key not in self.cache:
-            self.cache[key] = {}
-        hash = hashlib.md5(string).hexdigest()
-        self.cache[key][hash] = translations
+        self.cache.set(self._get_cache_key(string, source, target), translations)
 
     def _get_cache(self, string, source, target):
-        key = source + target
-        if key not in self.cache:
-            return []
-        hash = hashlib.md5(string).hexdigest()
-        if hash in self.cache[key]:
-            return self.cache[key][hash]
-        return []
+        """
+        Return the cached translations of the string or None if the string is not cached
+        """
+        return self.cache.get(self._get_cache_key(string, source, target))
+
+    def _get_cache_key(self, string, source, target):
+        """
+        The key contains the index versions of both cores, so that cached translations are not served anymore
+        once the index is modified, e.g. rebuilt by translations2solr.py
+        """
+        versions = [str(self.solr.get_core_version(source)), str(self.solr.get_core_version(target))]
+        return ':'.join([source, target] + versions + [self.settings_hash, hashlib.md5(string).hexdigest()])
 
     def _find_exact(self, string, lang):
         params = {
-            'q': 'value_lc:"%s %s %s"' % (Solr.DELIMITER_START, string, Solr.DELIMITER_END),
+            'q': self._get_exact_query(string),
             'rows': self.config['rows']
         }
         return self.solr.query(lang, params)
 
+    @staticmethod
+    def _get_exact_query(string):
+        return 'value_lc:"%s %s %s"' % (Solr.DELIMITER_START, string, Solr.DELIMITER_END)
+
 
 class TranslatorSolr(Translator):
     DEFAULT_CONFIG = {
         'rows': 100,  # Max. number of rows returned from search result
-        'max_string_length': 1024  # Max number of chars in the input strings, longer strings are ignored
+        'max_string_length': 1024,  # Max number of chars in the input strings, longer strings are ignored
+        'batch_lookups': True,  # Fetch the target translations of all source matches with a single request
+        'segmentation': 'heuristic',  # Algorithm translating strings by phrases, 'heuristic' or 'lattice' (may differ)
+        'max_phrase_length': 4,  # Max. number of words of a phrase in the lattice segmentation, 0 means no limit
+        'backend': 'solr',  # Where translations are looked up, 'solr' or 'index' (local phrase index, see phrase_index.py)
     }
 
-    def __init__(self, url='http://localhost:8983', config={}):
+    def __init__(self, url='http://localhost:8983', config={}, translations_cache=None):
+        """
+        url -- URL to Solr
+        config -- Decoder settings
+        translations_cache -- Instance of cache.LRUCache, defaults to the process-wide cache shared by all instances
+        """
         self.config = self.DEFAULT_CONFIG.copy()
         self.config.update(config)
-        self.solr = Solr('', url)
-        self.baseline = SolrBaselineSystem(self.solr, self.config)
+        self.solr = get_solr(url)
+        translations_cache = translations_cache if translations_cache is not None else cache.get_cache('solr')
+        dir_index = os.path.dirname(os.path.realpath(__file__)) + '/../data/index/'
+        self.baseline = SolrBaselineSystem(self.solr, self.config, translations_cache, dir_index)
 
     def get_id(self):
         return 'solr'
@@ -485,26 +627,7 @@ class TranslatorSolr(Translator):
     def get_all(self, string, lang_from, lang_to):
         pass
 
-    def translate_xml(self, xml, lang_from, lang_to):
-        translations = []
-        e = ExtractTranslationsFromXML(xml)
-        strings = e.extract()
-        debug = ''
-        for key, string in strings.iteritems():
-            translation, info = self.baseline.translate(utils.to_utf8(string), lang_from, lang_to)
-            row = {
-                'key': key,
-                'source': string,
-                'target': translation
-            }
-            translations.append(row)
-            debug += '\n\n\n' + info if debug else info
-        return {
-            'debug': debug,
-            'translations': translations
-        }
-
-    def get(self, strings, lang_from, lang_to):
+    def _get(self, strings, lang_from, lang_to):
         translations = []
         debug = ''
         for string in strings:
@@ -518,55 +641,81 @@ class TranslatorSolr(Translator):
 
 
 class TranslatorCompare(Translator):
+    BACKENDS = ['moses', 'tensorflow', 'solr']
+
     def __init__(self, config={}, decoder_settings={}):
         self.config = config
         self.decoder_settings = decoder_settings
         self.solr = TranslatorSolr(config['solr_url'], decoder_settings['solr'])
-        self.moses = TranslatorMoses(config['moses'], decoder_settings['moses'])
-        self.tensorflow = TranslatorTensorflow(decoder_settings['tensorflow'])
+        self.moses = TranslatorMoses(config['moses'], decoder_settings['moses'], config['moses_pool_size'],
+                                     config['decoder_timeout'], config['decoder_memory_budget'])
+        self.tensorflow = TranslatorTensorflow(decoder_settings['tensorflow'], config['tensorflow_pool_size'],
+                                               config['decoder_timeout'], config['decoder_memory_budget'])
 
     def get_all(self, string, lang_from, lang_to):
         pass
 
-    def translate_xml(self, xml, lang_from, lang_to):
-        translations = []
-        e = ExtractTranslationsFromXML(xml)
-        strings = e.extract()
-        result_moses = self.moses.get(strings, lang_from, lang_to)
-        result_solr = self.solr.get(strings, lang_from, lang_to)
-        result_tensorflow = self.tensorflow.get(strings, lang_from, lang_to)
-        i = 0
-        for key, string in strings.iteritems():
-            translations.append({
-                'key': key,
-                'source': string,
-                'moses': result_moses['translations'][i],
-                'tensorflow': result_tensorflow['translations'][i],
-                'solr': result_solr['translations'][i],
-            })
-            i += 1
-        return {
-            'debug': '',
-            'translations': translations
-        }
-
-    def get(self, strings, lang_from, lang_to):
-        results_moses = self.moses.get(strings, lang_from, lang_to)
-        results_tensorflow = self.tensorflow.get(strings, lang_from, lang_to)
-        results_solr = self.solr.get(strings, lang_from, lang_to)
+    def _get(self, strings, lang_from, lang_to):
+        results, debug, failed = self._get_from_backends(strings, lang_from, lang_to)
         translations = []
         for i, string in enumerate(strings):
-            translations.append({
+            row = {
                 'source': string,
-                'moses': results_moses['translations'][i],
-                'tensorflow': results_tensorflow['translations'][i],
-                'solr': results_solr['translations'][i],
-            })
+            }
+            for backend in self.BACKENDS:
+                row[backend] = results[backend][i]
+            translations.append(row)
         return {
-            'debug': '',
+            'debug': debug,
+            'failed': failed,
             'translations': translations
         }
 
+    def _get_from_backends(self, strings, lang_from, lang_to):
+        """
+        Translate the strings with all backends concurrently. A backend failing or exceeding its timeout does not
+        fail the request, its translations are set to None and the backend is listed as failed.
+        Returns a tuple (results, debug, failed) where results is a dictionary backend => list of translations
+        """
+        pool = ThreadPool(len(self.BACKENDS))
+        start = time.time()
+        jobs = {}
+        for backend in self.BACKENDS:
+            jobs[backend] = pool.apply_async(self._get_timed, (getattr(self, backend), strings, lang_from, lang_to))
+        # Do not wait for the threads of slow backends, they terminate once their decoder is finished
+        pool.close()
+        results = {}
+        debug = ''
+        failed = []
+        for backend in self.BACKENDS:
+            timeout = self.config['compare_timeouts'][backend]
+            try:
+                translations, seconds = jobs[backend].get(max(0, start + timeout - time.time()))
+                results[backend] = translations
+                debug += '\n%s: %.2f seconds' % (backend, seconds)
+            except multiprocessing.TimeoutError:
+                results[backend] = [None] * len(strings)
+                failed.append(backend)
+                debug += '\n%s: no result within %s seconds' % (backend, timeout)
+            except Exception as e:
+                results[backend] = [None] * len(strings)
+                failed.append(backend)
+                debug += '\n%s: failed (%s)' % (backend, str(e))
+        return results, debug.lstrip('\n'), failed
+
+    @staticmethod
+    def _get_xml_row(key, source, translation):
+        # The translation is a row containing the results of all backends, see get()
+        row = translation.copy()
+        row['key'] = key
+        return row
+
+    @staticmethod
+    def _get_timed(trans, strings, lang_from, lang_to):
+        start = time.time()
+        result = trans.get(strings, lang_from, lang_to)
+        return result['translations'], time.time() - start
+
 
 import getopt
 import sys
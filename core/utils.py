@@ -1,5 +1,8 @@
 import random
 import os
+import shutil
+import tempfile
+import itertools
 
 def to_utf8(string):
     if isinstance(string, unicode):
@@ -11,23 +14,94 @@ def to_ascii(string):
         return string.encode('ascii', 'replace')
     return string
 
-def shuffle_files(path1, path2):
+def chunks(iterable, size):
+    """
+    Yield lists of max. size items of the given iterable
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def shuffle_files(path1, path2, seed=None, max_memory=1024 ** 3, backup=True):
+    """
+    Shuffle the lines of two aligned files with the same permutation, in time linear to the number of lines
+    path1, path2 -- Files having the same number of lines, the n-th line of both files belongs together
+    seed -- Seed of the random permutation, the same seed results in the same permutation
+    max_memory -- Files larger than this number of bytes are shuffled on disk, see _shuffle_files_external
+    backup -- If true, the original files are kept with the extension '.bak'
+    """
+    rng = random.Random(seed)
+    if os.path.getsize(path1) + os.path.getsize(path2) <= max_memory:
+        _shuffle_files_memory(path1, path2, rng)
+    else:
+        _shuffle_files_external(path1, path2, rng, max_memory)
+    for path in [path1, path2]:
+        if backup:
+            os.rename(path, path + '.bak')
+        else:
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+def _shuffle_files_memory(path1, path2, rng):
     with open(path1) as file1:
         lines1 = file1.readlines()
-        n_lines = len(lines1)
-        indices = random.sample(range(0, n_lines), n_lines)
-        new_lines = []
-        for i, line in enumerate(lines1):
-            new_lines.insert(indices[i], line)
+    with open(path2) as file2:
+        lines2 = file2.readlines()
+    if len(lines1) != len(lines2):
+        raise Exception("'%s' and '%s' do not have the same number of lines" % (path1, path2))
+    order = range(len(lines1))
+    rng.shuffle(order)
+    with open(path1 + '.tmp', 'w') as temp1:
+        temp1.writelines([lines1[i] for i in order])
+    del lines1
+    with open(path2 + '.tmp', 'w') as temp2:
+        temp2.writelines([lines2[i] for i in order])
+
+def _shuffle_files_external(path1, path2, rng, max_memory):
+    """
+    Two pass shuffle for files not fitting into memory: Each pair of lines is scattered to a random bucket (a pair
+    of temporary files), then each bucket is shuffled in memory and appended to the output. Buckets are sized to
+    fit into max_memory on average.
+    """
+    size = os.path.getsize(path1) + os.path.getsize(path2)
+    # Twice the number of buckets needed on average, so that larger buckets still fit into memory
+    n_buckets = int(2 * size // max_memory) + 1
+    dir_temp = tempfile.mkdtemp(dir=os.path.dirname(os.path.realpath(path1)))
+    try:
+        buckets = [(os.path.join(dir_temp, '%d.1' % i), os.path.join(dir_temp, '%d.2' % i)) for i in range(n_buckets)]
+        files = []
+        try:
+            for bucket1, bucket2 in buckets:
+                files.append(open(bucket1, 'w', 1024 ** 2))
+                files.append(open(bucket2, 'w', 1024 ** 2))
+            with open(path1) as file1:
+                with open(path2) as file2:
+                    for line1, line2 in itertools.izip_longest(file1, file2):
+                        if line1 is None or line2 is None:
+                            raise Exception("'%s' and '%s' do not have the same number of lines" % (path1, path2))
+                        i = rng.randrange(n_buckets)
+                        files[2 * i].write(line1)
+                        files[2 * i + 1].write(line2)
+        finally:
+            for f in files:
+                f.close()
         with open(path1 + '.tmp', 'w') as temp1:
-            temp1.writelines(new_lines)
-        with open(path2) as file2:
-            new_lines = []
-            for i, line in enumerate(file2.readlines()):
-                new_lines.insert(indices[i], line)
             with open(path2 + '.tmp', 'w') as temp2:
-                temp2.writelines(new_lines)
-    os.rename(path1, path1 + '.bak')
-    os.rename(path2, path2 + '.bak')
-    os.rename(path1 + '.tmp', path1)
-    os.rename(path2 + '.tmp', path2)
\ No newline at end of file
+                for bucket1, bucket2 in buckets:
+                    with open(bucket1) as f:
+                        lines1 = f.readlines()
+                    with open(bucket2) as f:
+                        lines2 = f.readlines()
+                    order = range(len(lines1))
+                    rng.shuffle(order)
+                    temp1.writelines([lines1[i] for i in order])
+                    temp2.writelines([lines2[i] for i in order])
+                    os.remove(bucket1)
+                    os.remove(bucket2)
+    finally:
+        shutil.rmtree(dir_temp)
@@ -34,28 +34,52 @@ Parameters:
 --source                    Source language
 --target                    Target language
 --data_dir                  Output directory, where data and models are written
---corpus_idr                Corpus directory, containing parallel data
+--corpus_idr                Corpus directory, containing parallel data. If the run directory has no training files, the data
+                            of the run is read from the fold index (folds.json) written by write_corpus_bleu.py
 --size                      Size of network [default=1024]
 --num_layers                Number of layers in the model [default=3]
 --steps_per_checkpoint      How many training steps to do per checkpoint [default=200]
 --decode                    Set this flag to translate an input file, one sentence per line
 --replace_unknown           Set to true to replace unknown words with original input [default=True]
+--decode_batch_size         Max. number of sentences decoded together, grouped by bucket [default=32]
+--beam_size                 Beam width for decoding, 1 means greedy decoding [default=1]. Beam search is expensive: The model
+                            is built with its training graph (gradients and updates of all buckets), because the forward
+                            only graph feeds its own greedy outputs to the decoder. The decoder is also run again for
+                            every output position, so decoding time grows quadratically with the output length.
+--length_penalty            Beam search scores are normalized by length ** length_penalty [default=0.6]
+--preprocess_workers        Number of processes building the vocabularies and token ids [default=number of CPUs]
+--prefetch_batches          Batches assembled in background threads in advance per bucket, 0 disables prefetching [default=4]
+
+The vocabularies and token ids (int32 arrays, see prepare_data()) are written to the data directory of the model, together
+with a fingerprint of the corpus. Training again with an unchanged corpus skips the preprocessing.
+At each checkpoint, the statistics show the step time (model only), the average time to assemble a batch (batch-prep)
+and the time the training loop waited for prefetched batches (batch-wait), both in seconds per step.
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import collections
+import hashlib
+import json
 import math
+import multiprocessing
 import os
 import random
+import re
+import select
 import sys
+import threading
 import time
 import tensorflow.python.platform
 import numpy as np
+from six.moves import queue
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 from tensorflow.models.rnn.translate import data_utils
 from tensorflow.models.rnn.translate import seq2seq_model
 from tensorflow.python.platform import gfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'core'))
+import folds
 
 tf.app.flags.DEFINE_float("learning_rate", 0.5, "Learning rate.")
 tf.app.flags.DEFINE_float("learning_rate_decay_factor", 0.99,
@@ -84,6 +108,15 @@ tf.app.flags.DEFINE_string("target", "fr", "Target language")
 tf.app.flags.DEFINE_string("corpus_dir", "", "Corpus directory where monolingual and parallel data is stored")
 tf.app.flags.DEFINE_integer("run", -1, "Run")
 tf.app.flags.DEFINE_boolean("replace_unknown", True, "Replace unknown words (not in vocabulary) by original word")
+tf.app.flags.DEFINE_integer("decode_batch_size", 32, "Max. number of sentences decoded together.")
+tf.app.flags.DEFINE_integer("beam_size", 1, "Beam width used for decoding, 1 means greedy decoding. Beam search "
+                            "builds the training graph and reruns the decoder per output position, it needs more "
+                            "memory and time than greedy decoding.")
+tf.app.flags.DEFINE_float("length_penalty", 0.6, "Hypothesis scores are normalized by length ** length_penalty.")
+tf.app.flags.DEFINE_integer("preprocess_workers", multiprocessing.cpu_count(),
+                            "Number of processes building the vocabularies and token ids.")
+tf.app.flags.DEFINE_integer("prefetch_batches", 4,
+                            "Batches assembled in advance per bucket, 0 disables prefetching.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -91,46 +124,130 @@ FLAGS = tf.app.flags.FLAGS
 # See seq2seq_model.Seq2SeqModel for details of how they work.
 _buckets = [(5, 10), (10, 15), (20, 25), (40, 50)]
 
+# Increase if the format of the preprocessed data changes, so that it is created again.
+_PREPARE_VERSION = 1
 
-def read_data(source_path, target_path, max_size=None):
-    """Read data from source and target files and put into buckets.
 
-  Args:
-    source_path: path to the files with token-ids for the source language.
-    target_path: path to the file with token-ids for the target language;
-      it must be aligned with the source file: n-th line contains the desired
-      output for n-th line from the source_path.
-    max_size: maximum number of lines to read, all other will be ignored;
-      if 0 or None, data files will be read completely (no limit).
+class BucketedDataset(object):
+    """Sentence pairs of token ids grouped into buckets.
 
-  Returns:
-    data_set: a list of length len(_buckets); data_set[n] contains a list of
-      (source, target) pairs read from the provided data files that fit
-      into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
-      len(target) < _buckets[n][1]; source and target are lists of token-ids.
+  The token ids written by prepare_data() are memory-mapped, each bucket only holds the indexes of its
+  sentence pairs. Batches are sampled and padded with vectorized NumPy indexing.
+  """
+
+    def __init__(self, source_path, target_path, max_size=None):
+        """
+    Args:
+      source_path: path of the token ids of the source language, see _load_token_ids().
+      target_path: path of the token ids of the target language; it must be
+        aligned with the source: n-th sentence contains the desired
+        output for n-th sentence of the source.
+      max_size: maximum number of sentences to read, all other will be ignored;
+        if 0 or None, data is read completely (no limit).
+    """
+        self.source_ids, self.source_offsets = _load_token_ids(source_path, mmap_mode="r")
+        self.target_ids, self.target_offsets = _load_token_ids(target_path, mmap_mode="r")
+        size = min(len(self.source_offsets), len(self.target_offsets)) - 1
+        if max_size:
+            size = min(size, max_size)
+        source_lengths = np.diff(self.source_offsets[:size + 1])
+        # Targets are followed by the EOS symbol
+        target_lengths = np.diff(self.target_offsets[:size + 1]) + 1
+        # A pair is put into the first bucket it fits, i.e. len(source) < _buckets[n][0] and
+        # len(target) < _buckets[n][1], pairs not fitting into any bucket are skipped
+        self.buckets = []
+        assigned = np.zeros(size, dtype=bool)
+        for source_size, target_size in _buckets:
+            fits = ~assigned & (source_lengths < source_size) & (target_lengths < target_size)
+            self.buckets.append(np.flatnonzero(fits).astype(np.int64))
+            assigned |= fits
+
+    def get_bucket_sizes(self):
+        return [len(bucket) for bucket in self.buckets]
+
+    def get_batch(self, bucket_id, batch_size):
+        """Get a random batch of the given bucket, same format as returned by model.get_batch."""
+        encoder_size, decoder_size = _buckets[bucket_id]
+        pairs = self.buckets[bucket_id][np.random.randint(len(self.buckets[bucket_id]), size=batch_size)]
+        # Encoder inputs are padded and reversed: Position t holds the token (encoder_size - 1 - t) of the source
+        starts = self.source_offsets[pairs]
+        lengths = self.source_offsets[pairs + 1] - starts
+        positions = (encoder_size - 1 - np.arange(encoder_size))[:, np.newaxis]
+        mask = positions < lengths
+        encoder_inputs = np.full((encoder_size, batch_size), data_utils.PAD_ID, dtype=np.int32)
+        encoder_inputs[mask] = self.source_ids[(starts + positions)[mask]]
+        # Decoder inputs are the GO symbol followed by the target, the EOS symbol and padding
+        starts = self.target_offsets[pairs]
+        lengths = self.target_offsets[pairs + 1] - starts
+        positions = (np.arange(decoder_size) - 1)[:, np.newaxis]
+        mask = (positions >= 0) & (positions < lengths)
+        decoder_inputs = np.full((decoder_size, batch_size), data_utils.PAD_ID, dtype=np.int32)
+        decoder_inputs[mask] = self.target_ids[(starts + positions)[mask]]
+        decoder_inputs[0, :] = data_utils.GO_ID
+        decoder_inputs[lengths + 1, np.arange(batch_size)] = data_utils.EOS_ID
+        # The weight of a position is 0 if its target (the next decoder input) is padding
+        target_weights = np.zeros((decoder_size, batch_size), dtype=np.float32)
+        target_weights[:-1] = decoder_inputs[1:] != data_utils.PAD_ID
+        return list(encoder_inputs), list(decoder_inputs), list(target_weights)
+
+
+class BatchPrefetcher(object):
+    """Assembles the batches of a BucketedDataset in background threads.
+
+  Each non-empty bucket has a thread filling a bounded queue, so that the next batches are ready when the
+  training loop needs them. The time spent assembling batches is recorded separately from the time the
+  training loop waits for them.
   """
-    data_set = [[] for _ in _buckets]
-    with gfile.GFile(source_path, mode="r") as source_file:
-        with gfile.GFile(target_path, mode="r") as target_file:
-            source, target = source_file.readline(), target_file.readline()
-            counter = 0
-            while source and target and (not max_size or counter < max_size):
-                counter += 1
-                if counter % 100000 == 0:
-                    print("  reading data line %d" % counter)
-                    sys.stdout.flush()
-                source_ids = [int(x) for x in source.split()]
-                target_ids = [int(x) for x in target.split()]
-                target_ids.append(data_utils.EOS_ID)
-                for bucket_id, (source_size, target_size) in enumerate(_buckets):
-                    if len(source_ids) < source_size and len(target_ids) < target_size:
-                        data_set[bucket_id].append([source_ids, target_ids])
-                        break
-                source, target = source_file.readline(), target_file.readline()
-    return data_set
-
-
-def create_model(session, forward_only):
+
+    def __init__(self, dataset, batch_size, size):
+        """
+    Args:
+      dataset: instance of BucketedDataset.
+      batch_size: number of sentence pairs per batch.
+      size: max. number of batches queued per bucket; if 0, batches are assembled
+        when requested, without background threads.
+    """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.size = size
+        self.queues = [queue.Queue(max(1, size)) for _ in _buckets]
+        self.lock = threading.Lock()
+        self.prep_time = 0.0
+        self.batches = 0
+        if size > 0:
+            for bucket_id, bucket in enumerate(dataset.buckets):
+                if len(bucket):
+                    thread = threading.Thread(target=self._work, args=(bucket_id,))
+                    thread.daemon = True
+                    thread.start()
+
+    def get_batch(self, bucket_id):
+        """Return the next batch of the given bucket, same format as returned by model.get_batch."""
+        if self.size > 0:
+            return self.queues[bucket_id].get()
+        return self._assemble(bucket_id)
+
+    def pop_prep_time(self):
+        """Return the average time spent assembling a batch since the last call."""
+        with self.lock:
+            prep_time = self.prep_time / self.batches if self.batches else 0.0
+            self.prep_time, self.batches = 0.0, 0
+        return prep_time
+
+    def _assemble(self, bucket_id):
+        start_time = time.time()
+        batch = self.dataset.get_batch(bucket_id, self.batch_size)
+        with self.lock:
+            self.prep_time += time.time() - start_time
+            self.batches += 1
+        return batch
+
+    def _work(self, bucket_id):
+        while True:
+            self.queues[bucket_id].put(self._assemble(bucket_id))
+
+
+def create_model(session, forward_only, verbose=True):
     """Create translation model and initialize or load parameters in session."""
     model = seq2seq_model.Seq2SeqModel(
         FLAGS.source_vocab_size, FLAGS.target_vocab_size, _buckets,
@@ -140,11 +257,11 @@ def create_model(session, forward_only):
     model_dir = os.path.join(_get_base_output_dir(), 'model')
     ckpt = tf.train.get_checkpoint_state(model_dir)
     if ckpt and gfile.Exists(ckpt.model_checkpoint_path):
-        if not forward_only:
+        if verbose:
             print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
         model.saver.restore(session, ckpt.model_checkpoint_path)
     else:
-        if not forward_only:
+        if verbose:
             print("Created model with fresh parameters.")
         session.run(tf.initialize_all_variables())
     return model
@@ -164,37 +281,160 @@ def simple_tokenizer(sentence):
     """ Our corpus is already tokenized, so this tokenizer just splits at spaces """
     return sentence.split()
 
+def _get_chunks(lines, size=10000):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _count_words(lines):
+    """ Count the words of the given lines, normalized the same way as in data_utils.create_vocabulary """
+    counts = collections.Counter()
+    for line in lines:
+        for w in simple_tokenizer(line):
+            counts[re.sub(data_utils._DIGIT_RE, "0", w)] += 1
+    return counts
+
+def _create_vocabulary(vocabulary_path, lines, max_vocabulary_size):
+    """ Same as data_utils.create_vocabulary, but reading the sentences from an iterable and counting the words in
+    worker processes """
+    print("Creating vocabulary %s" % vocabulary_path)
+    vocab = collections.Counter()
+    pool = multiprocessing.Pool(FLAGS.preprocess_workers)
+    try:
+        for counts in pool.imap(_count_words, _get_chunks(lines)):
+            vocab.update(counts)
+    finally:
+        pool.close()
+        pool.join()
+    vocab_list = data_utils._START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+    with gfile.GFile(vocabulary_path, mode="w") as vocab_file:
+        for w in vocab_list[:max_vocabulary_size]:
+            vocab_file.write(w + "\n")
+
+_worker_vocab = None
+
+def _init_tokenizer(vocabulary_path):
+    global _worker_vocab
+    _worker_vocab, _ = data_utils.initialize_vocabulary(vocabulary_path)
+
+def _tokenize(lines):
+    """ Return the token ids of the given lines as flat int32 array and the number of ids per line """
+    ids = []
+    lengths = np.zeros(len(lines), dtype=np.int64)
+    for i, line in enumerate(lines):
+        token_ids = data_utils.sentence_to_token_ids(line, _worker_vocab)
+        ids.extend(token_ids)
+        lengths[i] = len(token_ids)
+    return np.array(ids, dtype=np.int32), lengths
+
+def _data_to_token_ids(lines, ids_path, vocabulary_path):
+    """ Tokenize the sentences in worker processes. The ids are saved to <ids_path>.ids.npy (int32) and the offsets
+    of the sentences to <ids_path>.offsets.npy, the ids of the i-th sentence are ids[offsets[i]:offsets[i + 1]] """
+    print("Tokenizing data to %s" % ids_path)
+    ids = [np.zeros(0, dtype=np.int32)]
+    lengths = [np.zeros(1, dtype=np.int64)]
+    pool = multiprocessing.Pool(FLAGS.preprocess_workers, _init_tokenizer, (vocabulary_path,))
+    try:
+        for chunk_ids, chunk_lengths in pool.imap(_tokenize, _get_chunks(lines)):
+            ids.append(chunk_ids)
+            lengths.append(chunk_lengths)
+    finally:
+        pool.close()
+        pool.join()
+    np.save(ids_path + ".ids.npy", np.concatenate(ids))
+    np.save(ids_path + ".offsets.npy", np.cumsum(np.concatenate(lengths)))
+
+def _load_token_ids(ids_path, mmap_mode=None):
+    return np.load(ids_path + ".ids.npy", mmap_mode), np.load(ids_path + ".offsets.npy", mmap_mode)
+
+def _read_lines(path):
+    with gfile.GFile(path, mode="r") as f:
+        for line in f:
+            yield line
+
+def _get_corpus_reader(pair_path, corpus_path):
+    """ Return a tuple (get_lines, files): A function (split, lang) => lines of the training or development data,
+    read from the files of the run directory or from the fold index of the language pair, and the files being read """
+    folds_file = os.path.join(pair_path, folds.INDEX_FILENAME)
+    if FLAGS.run > 0 and not os.path.isfile(os.path.join(corpus_path, "strings-train.clean." + FLAGS.source)) \
+            and os.path.isfile(folds_file):
+        print("Reading run %d from %s" % (FLAGS.run, folds_file))
+        index = folds.Folds(folds_file)
+        files = [folds_file] + [os.path.join(index.dir, f) for f in index.index['files'].values()]
+        return lambda split, lang: index.get_lines(FLAGS.run, split, lang), files
+    files = [os.path.join(corpus_path, "strings-%s.clean.%s" % (split, lang))
+             for split in ["train", "dev"] for lang in [FLAGS.source, FLAGS.target]]
+    return lambda split, lang: _read_lines(os.path.join(corpus_path, "strings-%s.clean.%s" % (split, lang))), files
+
+def _get_fingerprint(files):
+    """ Fingerprint of the corpus files (path, size and mtime) and of the settings used for preprocessing """
+    md5 = hashlib.md5()
+    md5.update(json.dumps([_PREPARE_VERSION, FLAGS.run, FLAGS.source, FLAGS.target,
+                           FLAGS.source_vocab_size, FLAGS.target_vocab_size]))
+    for path in sorted(files):
+        stat = os.stat(path)
+        md5.update("%s\t%d\t%d\n" % (os.path.realpath(path), stat.st_size, stat.st_mtime))
+    return md5.hexdigest()
+
+def prepare_data(pair_path, corpus_path, data_dir):
+    """Create the vocabularies and the token ids of the training and development data.
+
+  Preprocessing is skipped if the fingerprint of the corpus matches the one of the previous run.
+
+  Returns:
+    A dictionary (split, language) => path of the token ids, see _load_token_ids().
+  """
+    get_lines, files = _get_corpus_reader(pair_path, corpus_path)
+    vocab_paths = {
+        FLAGS.target: os.path.join(data_dir, "vocab%d.%s" % (FLAGS.target_vocab_size, FLAGS.target)),
+        FLAGS.source: os.path.join(data_dir, "vocab%d.%s" % (FLAGS.source_vocab_size, FLAGS.source)),
+    }
+    vocab_sizes = {FLAGS.target: FLAGS.target_vocab_size, FLAGS.source: FLAGS.source_vocab_size}
+    ids_paths = {}
+    for split in ["train", "dev"]:
+        for lang in [FLAGS.target, FLAGS.source]:
+            ids_paths[(split, lang)] = os.path.join(data_dir, "%s.ids%d.%s" % (split, vocab_sizes[lang], lang))
+
+    fingerprint_path = os.path.join(data_dir, "fingerprint")
+    fingerprint = _get_fingerprint(files)
+    if gfile.Exists(fingerprint_path):
+        with gfile.GFile(fingerprint_path, mode="r") as f:
+            if f.read().strip() == fingerprint:
+                print("Corpus unchanged, using the preprocessed data in %s" % data_dir)
+                return ids_paths
+        os.remove(fingerprint_path)
+
+    # Create vocabularies of the appropriate sizes.
+    for lang in [FLAGS.target, FLAGS.source]:
+        _create_vocabulary(vocab_paths[lang], get_lines("train", lang), vocab_sizes[lang])
+    # Create token ids for the training and development data.
+    for split in ["train", "dev"]:
+        for lang in [FLAGS.target, FLAGS.source]:
+            _data_to_token_ids(get_lines(split, lang), ids_paths[(split, lang)], vocab_paths[lang])
+
+    with gfile.GFile(fingerprint_path, mode="w") as f:
+        f.write(fingerprint + "\n")
+    return ids_paths
+
 def train():
     run = 'run-' + str(FLAGS.run) if FLAGS.run > 0 else ''
-    corpus_path = os.path.join(FLAGS.corpus_dir, 'parallel', FLAGS.source + '-' + FLAGS.target, run)
-    if not os.path.isdir(corpus_path):
-        corpus_path = os.path.join(FLAGS.corpus_dir, 'parallel', FLAGS.target + '-' + FLAGS.source, run)
+    pair_path = os.path.join(FLAGS.corpus_dir, 'parallel', FLAGS.source + '-' + FLAGS.target)
+    if not os.path.isdir(pair_path):
+        pair_path = os.path.join(FLAGS.corpus_dir, 'parallel', FLAGS.target + '-' + FLAGS.source)
+    corpus_path = os.path.join(pair_path, run)
     data_dir = _get_data_output_dir()
     if not os.path.isdir(data_dir):
         os.makedirs(data_dir)
-    train_path = data_dir
-    dev_path = data_dir
     model_dir = _get_model_output_dir()
     if not os.path.isdir(model_dir):
         os.makedirs(model_dir)
 
-    # Create vocabularies of the appropriate sizes.
-    target_vocab_path = os.path.join(data_dir, "vocab%d.%s" % (FLAGS.target_vocab_size, FLAGS.target))
-    source_vocab_path = os.path.join(data_dir, "vocab%d.%s" % (FLAGS.source_vocab_size, FLAGS.source))
-    data_utils.create_vocabulary(target_vocab_path, os.path.join(corpus_path, "strings-train.clean." + FLAGS.target), FLAGS.target_vocab_size, simple_tokenizer)
-    data_utils.create_vocabulary(source_vocab_path, os.path.join(corpus_path, "strings-train.clean." + FLAGS.source), FLAGS.source_vocab_size, simple_tokenizer)
-
-    # Create token ids for the training data.
-    target_train_ids_path = os.path.join(train_path + (".ids%d.%s" % (FLAGS.target_vocab_size, FLAGS.target)))
-    source_train_ids_path = os.path.join(train_path + (".ids%d.%s" % (FLAGS.source_vocab_size, FLAGS.source)))
-    data_utils.data_to_token_ids(os.path.join(corpus_path, "strings-train.clean." + FLAGS.target), target_train_ids_path, target_vocab_path)
-    data_utils.data_to_token_ids(os.path.join(corpus_path, "strings-train.clean." + FLAGS.source), source_train_ids_path, source_vocab_path)
-
-    # Create token ids for the development data.
-    target_dev_ids_path = os.path.join(dev_path + (".ids%d.%s" % (FLAGS.target_vocab_size, FLAGS.target)))
-    source_dev_ids_path = os.path.join(dev_path + (".ids%d.%s" % (FLAGS.source_vocab_size, FLAGS.source)))
-    data_utils.data_to_token_ids(os.path.join(corpus_path, "strings-dev.clean." + FLAGS.target), target_dev_ids_path, target_vocab_path)
-    data_utils.data_to_token_ids(os.path.join(corpus_path, "strings-dev.clean." + FLAGS.source), source_dev_ids_path, source_vocab_path)
+    ids_paths = prepare_data(pair_path, corpus_path, data_dir)
 
     with tf.Session() as sess:
         # Create model.
@@ -204,9 +444,10 @@ def train():
         # Read data into buckets and compute their sizes.
         print("Reading development and training data (limit: %d)."
               % FLAGS.max_train_data_size)
-        dev_set = read_data(source_dev_ids_path, target_dev_ids_path)
-        train_set = read_data(source_train_ids_path, target_train_ids_path, FLAGS.max_train_data_size)
-        train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
+        dev_set = BucketedDataset(ids_paths[("dev", FLAGS.source)], ids_paths[("dev", FLAGS.target)])
+        train_set = BucketedDataset(ids_paths[("train", FLAGS.source)], ids_paths[("train", FLAGS.target)],
+                                    FLAGS.max_train_data_size)
+        train_bucket_sizes = train_set.get_bucket_sizes()
         train_total_size = float(sum(train_bucket_sizes))
 
         # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
@@ -215,8 +456,11 @@ def train():
         train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
                                for i in xrange(len(train_bucket_sizes))]
 
+        # Batches are assembled in background threads while the model makes its steps.
+        prefetcher = BatchPrefetcher(train_set, FLAGS.batch_size, FLAGS.prefetch_batches)
+
         # This is the training loop.
-        step_time, loss = 0.0, 0.0
+        step_time, wait_time, loss = 0.0, 0.0, 0.0
         current_step = 0
         previous_losses = []
         while True:
@@ -228,8 +472,9 @@ def train():
 
             # Get a batch and make a step.
             start_time = time.time()
-            encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                train_set, bucket_id)
+            encoder_inputs, decoder_inputs, target_weights = prefetcher.get_batch(bucket_id)
+            wait_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
+            start_time = time.time()
             _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
                                          target_weights, bucket_id, False)
             step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
@@ -240,9 +485,9 @@ def train():
             if current_step % FLAGS.steps_per_checkpoint == 0:
                 # Print statistics for the previous epoch.
                 perplexity = math.exp(loss) if loss < 300 else float('inf')
-                print("global step %d learning rate %.4f step-time %.2f perplexity "
-                      "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                                step_time, perplexity))
+                print("global step %d learning rate %.4f step-time %.2f batch-prep %.4f batch-wait %.4f "
+                      "perplexity %.2f" % (model.global_step.eval(), model.learning_rate.eval(),
+                                           step_time, prefetcher.pop_prep_time(), wait_time, perplexity))
                 # Decrease learning rate if no improvement was seen over last 3 times.
                 if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
                     sess.run(model.learning_rate_decay_op)
@@ -251,11 +496,14 @@ def train():
                 # checkpoint_path = os.path.join(FLAGS.train_dir, "translate.ckpt")
                 checkpoint_path = os.path.join(model_dir, "translate.ckpt")
                 model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                step_time, loss = 0.0, 0.0
+                step_time, wait_time, loss = 0.0, 0.0, 0.0
                 # Run evals on development set and print their perplexity.
                 for bucket_id in xrange(len(_buckets)):
-                    encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                        dev_set, bucket_id)
+                    if not len(dev_set.buckets[bucket_id]):
+                        print("  eval: empty bucket %d" % bucket_id)
+                        continue
+                    encoder_inputs, decoder_inputs, target_weights = dev_set.get_batch(
+                        bucket_id, FLAGS.batch_size)
                     _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
                                                  target_weights, bucket_id, True)
                     eval_ppx = math.exp(eval_loss) if eval_loss < 300 else float('inf')
@@ -265,9 +513,15 @@ def train():
 
 def decode():
     with tf.Session() as sess:
-        # Create model and load parameters.
-        model = create_model(sess, True)
-        model.batch_size = 1  # We decode one sentence at a time.
+        # Create model and load parameters. Beam search needs a model feeding the given decoder inputs instead of
+        # its own greedy predictions, its outputs must then be projected to the target vocabulary. Seq2SeqModel only
+        # builds such a model with forward_only=False, i.e. including the gradients and update operations of all
+        # buckets, which costs memory. Greedy decoding (the default) uses the smaller forward only graph.
+        beam_search = FLAGS.beam_size > 1
+        model = create_model(sess, not beam_search, False)
+        projection = None
+        if beam_search and model.output_projection is not None:
+            projection = sess.run(list(model.output_projection))
 
         # Load vocabularies.
         source_vocab_path = os.path.join(_get_data_output_dir(),
@@ -277,62 +531,189 @@ def decode():
         source_vocab, _ = data_utils.initialize_vocabulary(source_vocab_path)
         _, target_vocab = data_utils.initialize_vocabulary(target_vocab_path)
 
-        for sentence in sys.stdin:
-            sentence = sentence.rstrip('\n')
-            # Get token-ids for the input sentence.
-            token_ids = data_utils.sentence_to_token_ids(sentence, source_vocab, None, False)
-
-            # Quit early...
-            if not len(token_ids):
-                print('')
-                continue
-
-            # Save unknown words in list
-            unknown_words = []
-            if FLAGS.replace_unknown:
-                words = data_utils.basic_tokenizer(sentence)
-                for i, token_id in enumerate(token_ids):
-                    if token_id == data_utils.UNK_ID:
-                        unknown_words.append(words[i])
-
-            bucket_list = [b for b in xrange(len(_buckets)) if _buckets[b][0] > len(token_ids)]
-            if not len(bucket_list):
-                print('')
-                continue
-
-            # Which bucket does it belong to?
-            bucket_id = min(bucket_list)
-            # Get a 1-element batch to feed the sentence to the model.
-            encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                {bucket_id: [(token_ids, [])]}, bucket_id)
-            # Get output logits for the sentence.
-            _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                             target_weights, bucket_id, True)
-            # This is a greedy decoder - outputs are just argmaxes of output_logits.
-            outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
-            # If there is an EOS symbol in outputs, cut them at that point.
-            if data_utils.EOS_ID in outputs:
-                outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-            # Print out sentence corresponding to outputs.
-            if not FLAGS.replace_unknown:
-                print(" ".join([target_vocab[output] for output in outputs]))
+        for sentences in _read_batches(max(1, FLAGS.decode_batch_size)):
+            translations = [''] * len(sentences)
+            # Sentences of a batch are grouped by bucket, each group is decoded with one step
+            buckets = {}
+            for i, sentence in enumerate(sentences):
+                # Get token-ids for the input sentence.
+                token_ids = data_utils.sentence_to_token_ids(sentence, source_vocab, None, False)
+
+                # Quit early...
+                if not len(token_ids):
+                    continue
+
+                # Save unknown words in list
+                unknown_words = []
+                if FLAGS.replace_unknown:
+                    words = data_utils.basic_tokenizer(sentence)
+                    for j, token_id in enumerate(token_ids):
+                        if token_id == data_utils.UNK_ID:
+                            unknown_words.append(words[j])
+
+                bucket_list = [b for b in xrange(len(_buckets)) if _buckets[b][0] > len(token_ids)]
+                if not len(bucket_list):
+                    continue
+
+                # Which bucket does it belong to?
+                bucket_id = min(bucket_list)
+                buckets.setdefault(bucket_id, []).append((i, token_ids, unknown_words))
+
+            for bucket_id, items in buckets.iteritems():
+                token_ids_list = [token_ids for _, token_ids, _ in items]
+                if beam_search:
+                    outputs = _beam_search(sess, model, projection, token_ids_list, bucket_id)
+                else:
+                    outputs = _greedy_search(sess, model, token_ids_list, bucket_id)
+                for b, (i, _, unknown_words) in enumerate(items):
+                    translations[i] = _get_sentence([int(o) for o in outputs[:, b]], unknown_words, target_vocab)
+
+            for translation in translations:
+                _write_line(translation)
+
+
+def _greedy_search(sess, model, token_ids_list, bucket_id):
+    """Decode the sentences of one bucket, returns the output token-ids as array of shape [decoder_size, batch]."""
+    encoder_inputs, decoder_inputs, target_weights = _get_decode_batch(token_ids_list, bucket_id)
+    model.batch_size = len(token_ids_list)
+    # Get output logits for the sentences.
+    _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
+                                     target_weights, bucket_id, True)
+    # This is a greedy decoder - outputs are just argmaxes of output_logits.
+    return np.array([np.argmax(logit, axis=1) for logit in output_logits])
+
+
+def _beam_search(sess, model, projection, token_ids_list, bucket_id):
+    """Beam search decoding of the sentences of one bucket, same return value as _greedy_search.
+
+    All hypotheses of all sentences are scored with one model step per output position. The model has no
+    incremental decoder state, each step runs the whole decoder again, so the cost grows quadratically with
+    the output length. Expanding and pruning the hypotheses is done with vectorized top-k selections over the
+    log-probabilities. The best hypothesis of each sentence is chosen by its score normalized by
+    length ** length_penalty.
+    """
+    beam_size = FLAGS.beam_size
+    batch_size = len(token_ids_list)
+    n = batch_size * beam_size
+    _, decoder_size = _buckets[bucket_id]
+    # Row b * beam_size + k holds the k-th hypothesis of the b-th sentence
+    encoder_inputs, decoder_inputs, target_weights = _get_decode_batch(
+        [token_ids for token_ids in token_ids_list for _ in xrange(beam_size)], bucket_id)
+    decoder_inputs = np.array(decoder_inputs)
+    hypotheses = np.full((n, decoder_size), data_utils.PAD_ID, dtype=np.int32)
+    # Only the first hypothesis is alive at the beginning, otherwise the beam is filled with duplicates
+    scores = np.full((batch_size, beam_size), -np.inf, dtype=np.float32)
+    scores[:, 0] = 0.0
+    scores = scores.reshape(n)
+    lengths = np.zeros(n, dtype=np.int32)
+    finished = np.zeros(n, dtype=bool)
+    offsets = np.arange(batch_size)[:, None]
+    model.batch_size = n
+    for t in xrange(decoder_size):
+        _, _, outputs = model.step(sess, encoder_inputs, list(decoder_inputs), target_weights, bucket_id, True)
+        logits = outputs[t] if projection is None else np.dot(outputs[t], projection[0]) + projection[1]
+        log_probs = _log_softmax(logits)
+        # Finished hypotheses are only extended by padding, without changing their score
+        log_probs[finished] = -np.inf
+        log_probs[finished, data_utils.PAD_ID] = 0.0
+        vocab_size = log_probs.shape[1]
+        candidates = (scores[:, None] + log_probs).reshape(batch_size, beam_size * vocab_size)
+        best = np.argpartition(-candidates, beam_size - 1, axis=1)[:, :beam_size]
+        best = best[offsets, np.argsort(-candidates[offsets, best], axis=1)]
+        parents = (best // vocab_size + offsets * beam_size).reshape(n)
+        tokens = (best % vocab_size).reshape(n)
+        scores = candidates[offsets, best].reshape(n)
+        hypotheses = hypotheses[parents]
+        hypotheses[:, t] = tokens
+        lengths = lengths[parents] + ~finished[parents]
+        finished = finished[parents] | (tokens == data_utils.EOS_ID)
+        if finished.all() or t + 1 == decoder_size:
+            break
+        # Feed the tokens chosen so far as decoder inputs for the next position
+        decoder_inputs[1:t + 2] = hypotheses[:, :t + 1].T
+    normalized = (scores / np.maximum(lengths, 1) ** FLAGS.length_penalty).reshape(batch_size, beam_size)
+    best = np.argmax(normalized, axis=1) + np.arange(batch_size) * beam_size
+    return hypotheses[best].T
+
+
+def _log_softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+
+def _get_decode_batch(token_ids_list, bucket_id):
+    """Build the model inputs to decode the given sentences, same format as returned by model.get_batch."""
+    encoder_size, decoder_size = _buckets[bucket_id]
+    batch_size = len(token_ids_list)
+    # Encoder inputs are padded and reversed, decoder inputs only consist of the GO symbol followed by padding
+    encoder_inputs = np.full((encoder_size, batch_size), data_utils.PAD_ID, dtype=np.int32)
+    for b, token_ids in enumerate(token_ids_list):
+        encoder_inputs[encoder_size - len(token_ids):, b] = token_ids[::-1]
+    decoder_inputs = np.full((decoder_size, batch_size), data_utils.PAD_ID, dtype=np.int32)
+    decoder_inputs[0, :] = data_utils.GO_ID
+    target_weights = np.zeros((decoder_size, batch_size), dtype=np.float32)
+    return list(encoder_inputs), list(decoder_inputs), list(target_weights)
+
+
+def _get_sentence(outputs, unknown_words, target_vocab):
+    """Convert the output token-ids of the decoder into a sentence."""
+    # If there is an EOS symbol in outputs, cut them at that point.
+    if data_utils.EOS_ID in outputs:
+        outputs = outputs[:outputs.index(data_utils.EOS_ID)]
+    if not FLAGS.replace_unknown:
+        return " ".join([target_vocab[output] for output in outputs])
+    # We replace each unknown word in the order they appeared in the input sentence
+    unknown_words = list(unknown_words)
+    words = []
+    prev_token_id = -1
+    for output in outputs:
+        if output == data_utils.UNK_ID:
+            if len(unknown_words):
+                words.append(unknown_words.pop(0))
+        else:
+            o = target_vocab[output]
+            # Hack alert!!
+            if prev_token_id == data_utils.UNK_ID and o == ';':
+                pass
             else:
-                # We replace each unknown word in the order they appeared in the input sentence
-                words = []
-                prev_token_id = -1
-                for output in outputs:
-                    if output == data_utils.UNK_ID:
-                        if len(unknown_words):
-                            words.append(unknown_words.pop(0))
-                    else:
-                        o = target_vocab[output]
-                        # Hack alert!!
-                        if prev_token_id == data_utils.UNK_ID and o == ';':
-                            pass
-                        else:
-                            words.append(o)
-                    prev_token_id = output
-                print(" ".join(words).strip())
+                words.append(o)
+        prev_token_id = output
+    return " ".join(words).strip()
+
+
+def _read_batches(batch_size):
+    """Yield lists of up to batch_size sentences read from stdin.
+
+    Sentences already available on stdin are decoded together, but we never wait for a batch to fill up,
+    so that the decoder can run as a resident process answering one request at a time.
+    """
+    fd = sys.stdin.fileno()
+    buf = b''
+    eof = False
+    while not eof:
+        sentences = []
+        while len(sentences) < batch_size:
+            if b'\n' in buf:
+                sentence, buf = buf.split(b'\n', 1)
+                sentences.append(sentence)
+                continue
+            if sentences and not select.select([fd], [], [], 0)[0]:
+                break
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                eof = True
+                if buf:
+                    sentences.append(buf)
+                break
+            buf += chunk
+        if sentences:
+            yield sentences
+
+
+def _write_line(line):
+    """Write a translation to stdout and flush, the caller may wait for it before sending more input."""
+    print(line)
+    sys.stdout.flush()
 
 
 def self_test():